@@ -1,163 +1,349 @@
 import os
+import logging
 import json
+import hashlib
+import sqlite3
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import List, Dict, Tuple
+import numpy as np
 import torch
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson是可选依赖
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
 
 # 配置
 EMBEDDING_MODEL_PATH = 'BAAI/bge-large-en-v1.5'
-EMBEDDING_MODEL_BATCH_SIZE = 32
+EMBEDDING_MODEL_BATCH_SIZE = 128
 EMBEDDING_MODEL_DEVICE = 'mps'
+# 'torch' 或 'onnx'；onnx后端通过ONNX Runtime推理（图融合，适合CPU），
+# 首次加载时sentence-transformers会自动导出 onnx/model.onnx
+EMBEDDING_MODEL_BACKEND = 'torch'
+EMBEDDING_MODEL_ONNX_FILE = 'onnx/model.onnx'
+# CPU上对Linear层做int8动态量化，权重约缩小4倍，推理快2-3倍
+EMBEDDING_MODEL_QUANTIZE = True
+EMBEDDING_CACHE_SIZE = 10000
+# 持久化的embedding缓存，设为None则关闭
+EMBEDDING_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'soft_heading', 'embeddings.sqlite')
 
 def extract_titles_from_outline(outline: List) -> List[str]:
     """从大纲中提取所有标题（包括子标题）"""
-    titles = []
-    for item in outline:
-        if isinstance(item, str):
-            titles.append(item)
-        elif isinstance(item, list):
-            titles.extend(item)
-    return titles
-
-def read_outlines(directory: str) -> Dict[str, List[str]]:
+    # 字符串是一级标题，列表是子标题，其他类型的元素忽略
+    return list(chain.from_iterable(
+        (item,) if isinstance(item, str) else item
+        for item in outline
+        if isinstance(item, (str, list))
+    ))
+
+def _load_outline_titles(filepath: str) -> Tuple[str, List[str], str]:
+    """读取单个outline文件，返回 (文件名, 标题列表, 错误信息)"""
+    filename = os.path.basename(filepath)
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    try:
+        outline = _json_loads(data)
+    except json.JSONDecodeError as e:
+        return filename, [], str(e)
+    return filename, extract_titles_from_outline(outline), ""
+
+def read_outlines(directory: str, max_workers: int = 16) -> Dict[str, List[str]]:
     """读取目录中的所有outline文件并提取标题"""
-    print(f"\nReading outlines from directory: {directory}")
+    logger.debug(f"Reading outlines from directory: {directory}")
     outlines = {}
     if not os.path.exists(directory):
-        print(f"Directory does not exist: {directory}")
+        logger.warning(f"Directory does not exist: {directory}")
         return outlines
         
-    files = os.listdir(directory)
-    print(f"Found {len(files)} files in directory")
+    # scandir直接给出entry.path，不需要再拼接路径
+    with os.scandir(directory) as entries:
+        files = list(entries)
+    logger.info(f"Found {len(files)} files in directory")
+    json_paths = [entry.path for entry in files if entry.name.endswith('.json')]
     
-    for filename in files:
-        if filename.endswith('.json'):
-            print(f"\nProcessing file: {filename}")
-            filepath = os.path.join(directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as f:
-                try:
-                    outline = json.load(f)
-                    titles = extract_titles_from_outline(outline)
-                    print(f"Extracted {len(titles)} titles from {filename}")
-                    print("First few titles:", titles[:3])
-                    outlines[filename] = titles
-                except json.JSONDecodeError as e:
-                    print(f"Error reading {filename}: {e}")
+    # 文件读取和解析是IO密集型，用线程池并行；worker内不打印，最后统一汇总
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filename, titles, error in executor.map(_load_outline_titles, json_paths):
+            if error:
+                logger.error(f"Error reading {filename}: {error}")
+            else:
+                outlines[filename] = titles
+    logger.info(f"Extracted {sum(len(t) for t in outlines.values())} titles from {len(outlines)} files")
     return outlines
 
+class EmbeddingCache:
+    """On-disk embedding cache keyed by (model id, sha256 of the text)"""
+    # SQLite单条语句的参数个数有上限，查询时分块
+    _CHUNK = 500
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL, '
+            'PRIMARY KEY (model, key))'
+        )
+
+    @staticmethod
+    def _key(doc: str) -> str:
+        return hashlib.sha256(doc.encode('utf-8')).hexdigest()
+
+    def get_many(self, model_id: str, docs: List[str]) -> Dict[str, np.ndarray]:
+        """Return cached vectors for the docs that are present"""
+        keys = {self._key(doc): doc for doc in docs}
+        key_list = list(keys)
+        found = {}
+        for start in range(0, len(key_list), self._CHUNK):
+            chunk = key_list[start:start + self._CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f'SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})',
+                [model_id, *chunk]
+            )
+            for key, vector in rows:
+                found[keys[key]] = np.frombuffer(vector, dtype=np.float16)
+        return found
+
+    def put_many(self, model_id: str, docs: List[str], vectors: np.ndarray):
+        """Store vectors as float16 bytes"""
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)',
+            [
+                (model_id, self._key(doc), vector.astype(np.float16).tobytes())
+                for doc, vector in zip(docs, vectors)
+            ]
+        )
+        self.conn.commit()
+
 class Encoder:
     def __init__(
             self,
             path=EMBEDDING_MODEL_PATH,
             batch_size=EMBEDDING_MODEL_BATCH_SIZE,
             device=EMBEDDING_MODEL_DEVICE,
+            backend=EMBEDDING_MODEL_BACKEND,
+            quantize=EMBEDDING_MODEL_QUANTIZE,
+            cache_path=EMBEDDING_CACHE_PATH,
             show_progress_bar=True
     ):
         self.batch_size = batch_size
         self.show_progress_bar = show_progress_bar
         prompt = 'Represent this sentence for searching relevant passages: ' if 'bge' in path and 'en' in path else None
-        print(f"\nInitializing encoder with model: {path}")
-        print(f"Using device: {device}")
+        logger.info(f"Initializing encoder with model: {path}")
+        logger.debug(f"Using device: {device}, backend: {backend}")
+        model_kwargs = {'file_name': EMBEDDING_MODEL_ONNX_FILE} if backend == 'onnx' else None
         self.model = SentenceTransformer(
             path,
             device=device,
             prompts={'query': prompt} if prompt else None,
-            default_prompt_name='query'
+            default_prompt_name='query',
+            backend=backend,
+            model_kwargs=model_kwargs
         )
+        # 动态量化只支持CPU上的PyTorch模型，MPS/CUDA保持原精度
+        self.quantized = quantize and backend == 'torch' and device == 'cpu'
+        if self.quantized:
+            logger.debug("Applying int8 dynamic quantization")
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        # 缓存键包含模型及其推理配置，换模型后旧的向量不会被命中
+        self.model_id = f"{path}|{backend}|{'qint8' if self.quantized else 'full'}|normalized"
+        self.cache = EmbeddingCache(cache_path) if cache_path else None
 
-    def encode_docs(self, docs: list[str]):
-        print(f"\nEncoding {len(docs)} documents")
-        embeddings = self.model.encode(
-            docs,
-            batch_size=self.batch_size,
-            show_progress_bar=self.show_progress_bar,
-            prompt_name=None,
-            normalize_embeddings=False
-        )
-        return embeddings
+    def encode_docs(self, docs: list[str]) -> torch.Tensor:
+        logger.debug(f"Encoding {len(docs)} documents")
+        device = self.model.device
+        cached = {}
+        if self.cache is not None:
+            cached = {
+                doc: torch.from_numpy(vector.astype(np.float32)).to(device)
+                for doc, vector in self.cache.get_many(self.model_id, docs).items()
+            }
+            logger.info(f"Found {len(cached)} cached embeddings")
+        missing = [doc for doc in dict.fromkeys(docs) if doc not in cached]
+        if missing:
+            # SentenceTransformer.encode 内部会按长度排序后再分batch并恢复原顺序，
+            # 标题都很短，较大的batch才能减少padding和调用次数
+            embeddings = self.model.encode(
+                missing,
+                batch_size=self.batch_size,
+                show_progress_bar=self.show_progress_bar,
+                prompt_name=None,
+                normalize_embeddings=True,
+                convert_to_tensor=True
+            ).to(device=device, dtype=torch.float32)
+            if self.cache is not None:
+                self.cache.put_many(self.model_id, missing, embeddings.cpu().numpy())
+            cached.update(zip(missing, embeddings))
+        return torch.stack([cached[doc] for doc in docs])
 
 class SoftHeadingRecallEvaluator:
-    def __init__(self):
+    def __init__(self, cache_size: int = EMBEDDING_CACHE_SIZE):
         self.encoder = Encoder()
+        # title -> embedding，跨文件复用，按LRU淘汰
+        self.cache_size = cache_size
+        self._embedding_cache = OrderedDict()
+
+    def _embed(self, titles: list[str]) -> torch.Tensor:
+        """Return embeddings for titles, encoding only those not cached yet"""
+        missing = [t for t in dict.fromkeys(titles) if t not in self._embedding_cache]
+        if missing:
+            embeddings = self.encoder.encode_docs(missing)
+            for title, embedding in zip(missing, embeddings):
+                self._embedding_cache[title] = embedding
+        rows = []
+        for title in titles:
+            self._embedding_cache.move_to_end(title)
+            rows.append(self._embedding_cache[title])
+        result = torch.stack(rows)
+        while len(self._embedding_cache) > self.cache_size:
+            self._embedding_cache.popitem(last=False)
+        return result
 
-    def _card(self, titles: list[str]) -> float:
-        embeddings = self.encoder.encode_docs(titles)
-        similarities = util.cos_sim(embeddings, embeddings)
-        count = 1 / torch.sum(similarities, dim=1)
-        card = torch.sum(count).item()
-        return card
-
-    def evaluate(self, generated_titles: list[str], reference_titles: list[str]) -> float:
-        print("\nEvaluating titles:")
-        print(f"Number of generated titles: {len(generated_titles)}")
-        print(f"Number of reference titles: {len(reference_titles)}")
+    def encode_titles(self, titles: list[str]) -> Dict[str, torch.Tensor]:
+        """Encode titles in one batch and return a title -> embedding map"""
+        unique_titles = list(dict.fromkeys(titles))
+        if not unique_titles:
+            return {}
+        embeddings = self._embed(unique_titles)
+        return {title: embeddings[i] for i, title in enumerate(unique_titles)}
+
+    def _card_from_embeddings(self, embeddings: torch.Tensor, weights: torch.Tensor = None) -> torch.Tensor:
+        """Soft cardinality of a multiset given the (unit-length) embeddings of its
+        unique items and their multiplicities (all ones when weights is None)"""
+        # GPU上用半精度做矩阵乘法，求和时回到FP32避免累加误差
+        if embeddings.device.type in ('mps', 'cuda'):
+            embeddings = embeddings.to(torch.float16)
+        if weights is None:
+            weights = torch.ones(embeddings.shape[0], device=embeddings.device)
+        weights = weights.to(device=embeddings.device, dtype=torch.float32)
+        # embedding已在编码时归一化，点积即余弦相似度。
+        # 重复标题的每个副本贡献相同：第i行的行和为 sum_j w_j e_i·e_j = e_i·(sum_j w_j e_j)，
+        # 一次矩阵-向量乘法即可，不需要构造N×N的相似度矩阵
+        total = (embeddings.float() * weights[:, None]).sum(dim=0)
+        row_sums = (embeddings @ total.to(embeddings.dtype)).float()
+        count = weights / row_sums
+        # 返回0维张量，留在设备上，避免每次都触发GPU->CPU同步
+        return torch.sum(count)
+
+    def evaluate(
+            self,
+            generated_titles: list[str],
+            reference_titles: list[str],
+            embeddings: Dict[str, torch.Tensor] = None
+    ) -> float:
+        logger.debug("Evaluating titles:")
+        logger.debug(f"Number of generated titles: {len(generated_titles)}")
+        logger.debug(f"Number of reference titles: {len(reference_titles)}")
         
         if not generated_titles or not reference_titles:
-            print("Warning: Empty title list detected")
+            logger.warning("Empty title list detected")
             return 0.
+        
+        # 两边标题及其出现次数完全相同时card_g、card_r和card_union相等，得分为1，无需编码；
+        # 只比较集合不够，重复标题的次数不同会改变card_g
+        if Counter(generated_titles) == Counter(reference_titles):
+            logger.debug("Identical title lists, score is 1.0")
+            return 1.
             
         union_titles = list(set(generated_titles).union(reference_titles))
-        print(f"Number of unique titles in union: {len(union_titles)}")
+        logger.debug(f"Number of unique titles in union: {len(union_titles)}")
+        
+        # union只编码一次，三个card都从同一个embedding矩阵中取行
+        if embeddings is None:
+            embeddings = self.encode_titles(union_titles)
+        union_embeddings = torch.stack([embeddings[t] for t in union_titles])
+        idx = {title: i for i, title in enumerate(union_titles)}
         
-        card_g = self._card(generated_titles)
-        card_r = self._card(reference_titles)
-        card_union = self._card(union_titles)
+        # 重复标题只取一行，按出现次数加权，结果与在原列表上计算一致
+        generated_counts = Counter(generated_titles)
+        reference_counts = Counter(reference_titles)
+        card_g = self._card_from_embeddings(
+            union_embeddings[[idx[t] for t in generated_counts]],
+            torch.tensor(list(generated_counts.values()))
+        )
+        card_r = self._card_from_embeddings(
+            union_embeddings[[idx[t] for t in reference_counts]],
+            torch.tensor(list(reference_counts.values()))
+        )
+        card_union = self._card_from_embeddings(union_embeddings)
         
-        print(f"Card_g: {card_g:.4f}")
-        print(f"Card_r: {card_r:.4f}")
-        print(f"Card_union: {card_union:.4f}")
+        # 读取card数值会同步设备，只在需要输出时才做
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Card_g: {card_g.item():.4f}")
+            logger.debug(f"Card_r: {card_r.item():.4f}")
+            logger.debug(f"Card_union: {card_union.item():.4f}")
         
         score = (card_r + card_g - card_union) / card_r
-        return score
+        return score.item()
 
 def compare_outlines(source_dir: str, reference_dir: str) -> Dict[str, float]:
     """比较两个目录中对应的outline文件"""
-    print("\nStarting outline comparison")
+    logger.info("Starting outline comparison")
     evaluator = SoftHeadingRecallEvaluator()
     
-    print("\nReading source outlines")
+    logger.debug("Reading source outlines")
     source_outlines = read_outlines(source_dir)
-    print(f"Found {len(source_outlines)} source outlines")
+    logger.info(f"Found {len(source_outlines)} source outlines")
     
-    print("\nReading reference outlines")
+    logger.debug("Reading reference outlines")
     reference_outlines = read_outlines(reference_dir)
-    print(f"Found {len(reference_outlines)} reference outlines")
+    logger.info(f"Found {len(reference_outlines)} reference outlines")
+    
+    # 先收集所有匹配文件的标题，统一编码一次，再按文件取用
+    all_titles = []
+    for filename, titles in source_outlines.items():
+        if filename in reference_outlines:
+            all_titles.extend(titles)
+            all_titles.extend(reference_outlines[filename])
+    logger.debug(f"Encoding {len(set(all_titles))} unique titles across all files")
+    embeddings = evaluator.encode_titles(all_titles)
     
     results = {}
     for filename in source_outlines:
-        print(f"\nProcessing file: {filename}")
+        logger.debug(f"Processing file: {filename}")
         if filename in reference_outlines:
             score = evaluator.evaluate(
                 source_outlines[filename],
-                reference_outlines[filename]
+                reference_outlines[filename],
+                embeddings=embeddings
             )
             results[filename] = score
-            print(f"Score: {score:.4f}")
+            logger.info(f"Score: {score:.4f}")
         else:
-            print(f"No matching reference file found for {filename}")
+            logger.warning(f"No matching reference file found for {filename}")
     
     return results
 
 def main():
-    print("Starting evaluation process...")
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING"))
+    logger.info("Starting evaluation process...")
     
     # 获取当前脚本的目录
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    print(f"Current directory: {current_dir}")
+    logger.debug(f"Current directory: {current_dir}")
     
     # 定义源目录和参考目录
     source_dir = os.path.join(current_dir, "outline")
     reference_dir = os.path.join(current_dir, "sourceoutline")
     
-    print(f"\nSource directory: {source_dir}")
-    print(f"Reference directory: {reference_dir}")
+    logger.debug(f"Source directory: {source_dir}")
+    logger.debug(f"Reference directory: {reference_dir}")
     
     # 检查目录是否存在
     if not os.path.exists(source_dir):
-        print(f"Error: Source directory does not exist: {source_dir}")
+        logger.error(f"Source directory does not exist: {source_dir}")
         return
     if not os.path.exists(reference_dir):
-        print(f"Error: Reference directory does not exist: {reference_dir}")
+        logger.error(f"Reference directory does not exist: {reference_dir}")
         return
     
     # 比较outlines
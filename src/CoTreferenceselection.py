@@ -3,98 +3,125 @@ Reference Selection Agent - Selects relevant references for each section with an
 """
 
 import os
-import json
+import logging
 import re
-from typing import List, Dict, Tuple
-import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from config import client, model_name
+from utils import dump_json, load_prompts, list_paper_ids, prefill_prompt, fill_prompt, strip_tag
+from paper_store import PaperStore
+from paper_info import PaperInfo
+
+logger = logging.getLogger(__name__)
+
+_REFS_RE = re.compile(r'<refs>(.*?)</refs>', re.DOTALL)
+_REF_LINE_RE = re.compile(r'\[\d+\]')
+# 第一组是Subjects:到References:之间的整块，第二组是每一行Title:的内容
+_PARSE_RE = re.compile(r'^Subjects:[ \t]*\n(?s:(.*?))^References:[ \t]*$|^Title:[ \t]*(.*)$', re.MULTILINE)
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+_COTREFERENCES_DIR = os.path.join(_BASE_DIR, 'CoTreferences')
 
 class ReferenceSelectionAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the Reference Selection Agent"""
-        print("Initializing ReferenceSelectionAgent...")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
-        print(f"Loading prompt from: {prompt_file}")
+        logger.debug("Initializing ReferenceSelectionAgent...")
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
+        logger.debug(f"Loading prompt from: {prompt_file}")
         self.prompt = self._load_prompt(prompt_file)
         
         # 创建reference_selection输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'CoTreferences')
+        self.output_dir = _COTREFERENCES_DIR
         os.makedirs(self.output_dir, exist_ok=True)
-        print(f"Output directory: {self.output_dir}")
+        logger.debug(f"Output directory: {self.output_dir}")
+        
+        # 同一篇论文的各个section并发请求GPT的最大线程数
+        self.max_workers = 16
+        # 所有论文共用一个线程池，不再为每篇论文创建和销毁线程
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        
+        # 前面agent写入的title/outline优先从内存store读取，没有时再读磁盘
+        self.store = store if store is not None else PaperStore()
 
     def _load_prompt(self, prompt_file: str) -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'reference_selection_prompt' not in prompt_data:
-                    raise KeyError("'reference_selection_prompt' not found in YAML file")
-                print("Prompt loaded successfully")
-                return prompt_data['reference_selection_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if 'reference_selection_prompt' not in prompt_data:
+                raise KeyError("'reference_selection_prompt' not found in YAML file")
+            logger.debug("Prompt loaded successfully")
+            return prompt_data['reference_selection_prompt']
         except Exception as e:
-            print(f"Error loading prompt file: {e}")
+            logger.error(f"Error loading prompt file: {e}")
             raise
 
-    def _read_paper_info(self, paper_id: str) -> Dict:
+    def _read_paper_info(self, paper_id: str) -> Optional[PaperInfo]:
         """Read all necessary information for a paper"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            
             # Read subject and references
-            test_file = os.path.join(current_dir, 'test', f'{paper_id}.txt')
+            test_file = os.path.join(_TEST_DIR, f'{paper_id}.txt')
             with open(test_file, 'r', encoding='utf-8') as f:
                 content = f.read()
+            # 一次正则扫描同时取出Subjects块和所有Title:行，subject取块中最后一个有效行
             subject = ""
             references = []
-            current_section = ""
-            
-            for line in content.split('\n'):
-                line = line.strip()
-                if line == "Subjects:":
-                    current_section = "subjects"
-                elif line == "References:":
-                    current_section = "references"
-                elif line and current_section == "subjects" and line != "Subjects:":
-                    if not line.startswith(('References:', 'Number:', 'Title:', 'Abstract:')):
-                        subject = line
-                elif line and current_section == "references":
-                    if line.startswith('Title:'):
-                        references.append(line[6:].strip())
+            for match in _PARSE_RE.finditer(content):
+                if match.group(1) is not None:
+                    for line in match.group(1).split('\n'):
+                        line = line.strip()
+                        if line and not line.startswith(('Subjects:', 'Number:', 'Title:', 'Abstract:')):
+                            subject = line
+                else:
+                    references.append(match.group(2).strip())
             
             # Read title
-            title_file = os.path.join(current_dir, 'title', f'{paper_id}.json')
-            with open(title_file, 'r', encoding='utf-8') as f:
-                title_data = json.load(f)
-                title = re.sub(r'<title>|</title>', '', title_data.get('title', '')).strip()
+            title_file = os.path.join(_TITLE_DIR, f'{paper_id}.json')
+            title_data = self.store.load(paper_id, 'title', title_file)
+            title = strip_tag(title_data.get('title', ''), 'title')
             
             # Read outline and clean it
-            outline_file = os.path.join(current_dir, 'outline', f'{paper_id}.json')
-            with open(outline_file, 'r', encoding='utf-8') as f:
-                outline_data = json.load(f)
-                # 清理大纲，移除标签和非章节内容
-                sections = outline_data.get('sections', [])
-                cleaned_sections = []
-                for section in sections:
-                    if not (section.startswith('<outline>') or 
-                           section.startswith('</outline>') or
-                           section == ""):
-                        cleaned_sections.append(section)
+            outline_file = os.path.join(_OUTLINE_DIR, f'{paper_id}.json')
+            outline_data = self.store.load(paper_id, 'outline', outline_file)
+            # 清理大纲，移除标签和非章节内容
+            sections = outline_data.get('sections', [])
+            cleaned_sections = []
+            for section in sections:
+                if not (section.startswith('<outline>') or 
+                       section.startswith('</outline>') or
+                       section == ""):
+                    cleaned_sections.append(section)
             
-            return {
-                'subject': subject,
-                'title': title,
-                'outline': cleaned_sections,
-                'references': '\n'.join(references)
-            }
+            # 大纲和参考文献每篇论文只拼接一次
+            outline_str = '\n'.join(cleaned_sections)
+            references = '\n'.join(references)
+            return PaperInfo(
+                subject=subject,
+                title=title,
+                outline=cleaned_sections,
+                outline_str=outline_str,
+                references=references,
+                # 除section外的字段对同一篇论文都相同，只填一次
+                prompt_parts=prefill_prompt(
+                    self.prompt,
+                    subject=subject,
+                    title=title,
+                    outline=outline_str,
+                    references=references
+                )
+            )
         except Exception as e:
-            print(f"Error reading paper info: {e}")
-            return {}
+            logger.error(f"Error reading paper info: {e}")
+            return None
 
     def _extract_final_refs(self, response: str) -> str:
         """Extract the final reference list from the response"""
         # 查找<refs>标签之间的内容
-        match = re.search(r'<refs>(.*?)</refs>', response, re.DOTALL)
+        match = _REFS_RE.search(response)
         if match:
             refs_content = match.group(1).strip()
             return f"<refs>\n{refs_content}\n</refs>"
@@ -103,11 +130,11 @@ class ReferenceSelectionAgent:
     def _verify_refs_format(self, refs: str) -> bool:
         """Verify if the references are in correct format"""
         if not refs:
-            print("References format verification failed: Empty response")
+            logger.debug("References format verification failed: Empty response")
             return False
             
         if not (refs.startswith('<refs>') and refs.endswith('</refs>')):
-            print("References format verification failed: Missing tags")
+            logger.debug("References format verification failed: Missing tags")
             return False
             
         content = refs[6:-7].strip()  # Remove tags
@@ -115,38 +142,32 @@ class ReferenceSelectionAgent:
         
         # Check if each line starts with * and contains [number]
         for line in lines:
-            if not (line.startswith('*') and re.search(r'\[\d+\]', line)):
-                print(f"References format verification failed: Invalid line format: {line}")
+            if not (line.startswith('*') and _REF_LINE_RE.search(line)):
+                logger.debug(f"References format verification failed: Invalid line format: {line}")
                 return False
         
-        print(f"References format verification passed: {len(lines)} references selected")
+        logger.debug(f"References format verification passed: {len(lines)} references selected")
         return True
 
-    def _get_refs_for_section(self, paper_info: Dict, section: str) -> str:
+    def _get_refs_for_section(self, paper_info: PaperInfo, section: str) -> str:
         """Get reference selection from GPT for a specific section"""
         try:
-            print(f"\nSelecting references for section: {section}")
-            formatted_prompt = self.prompt.format(
-                subject=paper_info['subject'],
-                title=paper_info['title'],
-                outline='\n'.join(paper_info['outline']),
-                section=section,
-                references=paper_info['references']
-            )
+            logger.debug(f"Selecting references for section: {section}")
+            formatted_prompt = fill_prompt(paper_info.prompt_parts, section=section)
             messages = [{"role": "user", "content": formatted_prompt}]
             
             retry_count = 0
             max_retries = 3
             
             while retry_count < max_retries:  # 限制重试次数
-                print(f"Attempt {retry_count + 1}/{max_retries}")
+                logger.debug(f"Attempt {retry_count + 1}/{max_retries}")
                 response = client.chat.completions.create(
                     model=model_name,
                     messages=messages,
                     temperature=0.7
                 )
                 full_response = response.choices[0].message.content.strip()
-                print("Received response, extracting reference list...")
+                logger.debug("Received response, extracting reference list...")
                 
                 # 提取最终的参考文献列表
                 refs = self._extract_final_refs(full_response)
@@ -163,65 +184,81 @@ class ReferenceSelectionAgent:
                     "Provide your analysis first, then the properly formatted reference list."
                 )
                 
-                messages.extend([
+                # 只保留原prompt和最近一次回答，不累积之前的对话
+                messages = [
+                    {"role": "user", "content": formatted_prompt},
                     {"role": "assistant", "content": full_response},
                     {"role": "user", "content": correction_message}
-                ])
-                print("Incorrect format detected, requesting correction...")
+                ]
+                logger.info("Incorrect format detected, requesting correction...")
                 retry_count += 1
             
             # 如果达到最大重试次数，尝试最后一次提取
-            print("Maximum retries reached, attempting to extract from last response")
+            logger.warning("Maximum retries reached, attempting to extract from last response")
             return self._extract_final_refs(full_response)
                 
         except Exception as e:
-            print(f"Error getting GPT response: {e}")
+            logger.error(f"Error getting GPT response: {e}")
             return ""
 
     def _save_refs(self, paper_id: str, section_refs: Dict[str, List[str]]):
         """Save selected references to JSON file"""
         output_file = os.path.join(self.output_dir, f'{paper_id}.json')
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(section_refs, f, indent=2, ensure_ascii=False)
-        print(f"Saved references to: {output_file}")
+        dump_json(section_refs, output_file)
+        self.store.put(paper_id, 'CoTreferences', section_refs)
+        logger.info(f"Saved references to: {output_file}")
+
+    def process_one(self, paper_id: str) -> None:
+        """Select and save the references of each section for a single paper"""
+        logger.info(f"Processing paper: {paper_id}")
+        
+        # Read paper information
+        paper_info = self._read_paper_info(paper_id)
+        if not paper_info:
+            logger.warning(f"Skipping paper {paper_id} due to missing information")
+            return
+        
+        # Process each section
+        # 主要耗时在API网络请求上，各section并发请求，按大纲顺序收集结果
+        sections = [
+            section for section in paper_info.outline
+            if section not in ['Introduction', 'Conclusion']  # Skip intro and conclusion
+        ]
+        section_refs = {}
+        all_refs = list(self.executor.map(
+            lambda section: self._get_refs_for_section(paper_info, section),
+            sections
+        ))
+        for section, refs in zip(sections, all_refs):
+            if refs:
+                # Extract reference list
+                content = refs[6:-7].strip()  # Remove <refs> tags
+                ref_list = [line.strip() for line in content.split('\n') if line.strip()]
+                section_refs[section] = ref_list
+                logger.info(f"Selected {len(ref_list)} references for section: {section}")
+        
+        # Save results
+        self._save_refs(paper_id, section_refs)
+        logger.info(f"Completed reference selection for paper: {paper_id}")
 
     def process_papers(self) -> None:
         """Process all papers that have title and outline"""
-        print("\nStarting reference selection process...")
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        title_dir = os.path.join(current_dir, 'title')
-        
-        for file_name in os.listdir(title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Read paper information
-                paper_info = self._read_paper_info(paper_id)
-                if not paper_info:
-                    print(f"Skipping paper {paper_id} due to missing information")
-                    continue
-                
-                # Process each section
-                section_refs = {}
-                for section in paper_info['outline']:
-                    if section not in ['Introduction', 'Conclusion']:  # Skip intro and conclusion
-                        refs = self._get_refs_for_section(paper_info, section)
-                        if refs:
-                            # Extract reference list
-                            content = refs[6:-7].strip()  # Remove <refs> tags
-                            ref_list = [line.strip() for line in content.split('\n') if line.strip()]
-                            section_refs[section] = ref_list
-                            print(f"Selected {len(ref_list)} references for section: {section}")
-                
-                # Save results
-                self._save_refs(paper_id, section_refs)
-                print(f"Completed reference selection for paper: {paper_id}")
+        logger.info("Starting reference selection process...")
+        for paper_id in list_paper_ids(_TITLE_DIR):
+            self.process_one(paper_id)
+
+    def close(self) -> None:
+        """Shut down the section thread pool once processing is finished"""
+        self.executor.shutdown()
 
 def main():
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING"))
     agent = ReferenceSelectionAgent()
-    agent.process_papers()
-    print("\nReference selection completed!")
+    try:
+        agent.process_papers()
+    finally:
+        agent.close()
+    logger.info("Reference selection completed!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
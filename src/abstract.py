@@ -3,45 +3,58 @@ Abstract Generation Agent - Generates paper abstract based on title and outline
 """
 
 import os
-import json
-import re
-from typing import List, Dict, Tuple
-import yaml
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from config import client, model_name
+from utils import dump_json, load_prompts, list_paper_ids, strip_tag
+from paper_store import PaperStore
+
+logger = logging.getLogger(__name__)
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+_ABSTRACT_DIR = os.path.join(_BASE_DIR, 'abstract')
 
 class AbstractAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the Abstract Agent"""
-        print("Initializing AbstractAgent...")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
-        print(f"Loading prompt from: {prompt_file}")
+        logger.debug("Initializing AbstractAgent...")
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
+        logger.debug(f"Loading prompt from: {prompt_file}")
         self.prompt = self._load_prompt(prompt_file)
         
         # 创建abstract输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'abstract')
+        self.output_dir = _ABSTRACT_DIR
         os.makedirs(self.output_dir, exist_ok=True)
-        print(f"Output directory: {self.output_dir}")
+        logger.debug(f"Output directory: {self.output_dir}")
+        
+        # 多篇论文并发请求GPT的最大线程数
+        self.max_workers = 20
+        
+        # 前面agent写入的title/outline优先从内存store读取，没有时再读磁盘
+        self.store = store if store is not None else PaperStore()
 
     def _load_prompt(self, prompt_file: str) -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'abstract_prompt' not in prompt_data:
-                    raise KeyError("'abstract_prompt' not found in YAML file")
-                print("Prompt loaded successfully")
-                return prompt_data['abstract_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if 'abstract_prompt' not in prompt_data:
+                raise KeyError("'abstract_prompt' not found in YAML file")
+            logger.debug("Prompt loaded successfully")
+            return prompt_data['abstract_prompt']
         except Exception as e:
-            print(f"Error: Failed to load abstract_prompt from {prompt_file}")
-            print(f"Detailed error: {str(e)}")
+            logger.error(f"Failed to load abstract_prompt from {prompt_file}: {e}")
             raise
 
     def _read_subject_from_test(self, paper_id: str) -> str:
         """Read subject from test file"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            test_file = os.path.join(current_dir, 'test', f'{paper_id}.txt')
+            test_file = os.path.join(_TEST_DIR, f'{paper_id}.txt')
             
             with open(test_file, 'r', encoding='utf-8') as f:
                 content = f.read()
@@ -52,59 +65,53 @@ class AbstractAgent:
                         return line.strip()
             return ""
         except Exception as e:
-            print(f"Error reading subject: {e}")
+            logger.error(f"Error reading subject: {e}")
             return ""
 
     def _read_title_from_file(self, paper_id: str) -> str:
         """Read title from title directory"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            title_file = os.path.join(current_dir, 'title', f'{paper_id}.json')
+            title_file = os.path.join(_TITLE_DIR, f'{paper_id}.json')
             
-            with open(title_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                title = data.get('title', '')
-                # Remove tags if present
-                title = re.sub(r'<title>|</title>', '', title)
-                return title.strip()
+            data = self.store.load(paper_id, 'title', title_file)
+            # Remove tags if present
+            return strip_tag(data.get('title', ''), 'title')
         except Exception as e:
-            print(f"Error reading title: {e}")
+            logger.error(f"Error reading title: {e}")
             return ""
 
     def _read_outline_from_file(self, paper_id: str) -> List[str]:
         """Read outline from outline directory"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            outline_file = os.path.join(current_dir, 'outline', f'{paper_id}.json')
+            outline_file = os.path.join(_OUTLINE_DIR, f'{paper_id}.json')
             
-            with open(outline_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('sections', [])
+            data = self.store.load(paper_id, 'outline', outline_file)
+            return data.get('sections', [])
         except Exception as e:
-            print(f"Error reading outline: {e}")
+            logger.error(f"Error reading outline: {e}")
             return []
 
     def _verify_abstract_format(self, abstract: str) -> bool:
         """Verify if the abstract is in correct format and length"""
         if not (abstract.startswith('<abstract>') and abstract.endswith('</abstract>')):
-            print("Abstract format verification failed: Missing tags")
+            logger.debug("Abstract format verification failed: Missing tags")
             return False
             
         # Remove tags and count words
-        content = re.sub(r'<abstract>|</abstract>', '', abstract).strip()
+        content = strip_tag(abstract, 'abstract')
         word_count = len(content.split())
         
         if not (200 <= word_count <= 500):
-            print(f"Abstract format verification failed: Word count {word_count} not in range [200, 500]")
+            logger.debug(f"Abstract format verification failed: Word count {word_count} not in range [200, 500]")
             return False
             
-        print("Abstract format verification passed")
+        logger.debug("Abstract format verification passed")
         return True
 
     def _get_abstract_from_gpt(self, subject: str, title: str, outline: List[str]) -> str:
         """Get abstract suggestion from GPT"""
         try:
-            print("\nGenerating abstract using GPT...")
+            logger.debug("Generating abstract using GPT...")
             outline_text = '\n'.join(outline)
             formatted_prompt = self.prompt.format(
                 subject=subject,
@@ -114,7 +121,7 @@ class AbstractAgent:
             messages = [{"role": "user", "content": formatted_prompt}]
             
             while True:  # 循环直到获得正确格式的响应
-                print("Sending request to GPT...")
+                logger.debug("Sending request to GPT...")
                 response = client.chat.completions.create(
                     model=model_name,
                     messages=messages,
@@ -122,7 +129,7 @@ class AbstractAgent:
                     max_tokens=1000  # Ensure enough tokens for abstract
                 )
                 abstract = response.choices[0].message.content.strip()
-                print(f"Received response of length: {len(abstract)}")
+                logger.debug(f"Received response of length: {len(abstract)}")
                 
                 if self._verify_abstract_format(abstract):
                     return abstract
@@ -140,10 +147,10 @@ class AbstractAgent:
                     {"role": "assistant", "content": abstract},
                     {"role": "user", "content": correction_message}
                 ])
-                print("Incorrect format detected, requesting correction...")
+                logger.info("Incorrect format detected, requesting correction...")
                 
         except Exception as e:
-            print(f"Error getting GPT response: {e}")
+            logger.error(f"Error getting GPT response: {e}")
             return ""
 
     def _save_abstract(self, paper_id: str, abstract: str):
@@ -153,54 +160,56 @@ class AbstractAgent:
             'paper_id': paper_id,
             'abstract': abstract
         }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
-        print(f"Saved abstract to: {output_file}")
+        dump_json(result, output_file)
+        self.store.put(paper_id, 'abstract', result)
+        logger.info(f"Saved abstract to: {output_file}")
+
+    def process_one(self, paper_id: str) -> Dict[str, str]:
+        """Generate and save the abstract for a single paper"""
+        logger.info(f"Processing paper: {paper_id}")
+        
+        # Read necessary information
+        subject = self._read_subject_from_test(paper_id)
+        title = self._read_title_from_file(paper_id)
+        outline = self._read_outline_from_file(paper_id)
+        
+        if subject and title and outline:
+            logger.info(f"Found all required information for {paper_id}")
+            abstract = self._get_abstract_from_gpt(subject, title, outline)
+            
+            if abstract:
+                self._save_abstract(paper_id, abstract)
+                logger.info(f"Generated abstract for {paper_id}")
+                return {
+                    'paper_id': paper_id,
+                    'abstract': abstract
+                }
+        else:
+            logger.warning(f"Missing information for {paper_id}")
+            if not subject:
+                logger.warning("- Missing subject")
+            if not title:
+                logger.warning("- Missing title")
+            if not outline:
+                logger.warning("- Missing outline")
+        return {}
 
     def process_papers(self) -> List[Dict[str, str]]:
         """Process all papers that have both title and outline"""
-        print("\nStarting abstract generation process...")
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        title_dir = os.path.join(current_dir, 'title')
+        logger.info("Starting abstract generation process...")
+        paper_ids = list_paper_ids(_TITLE_DIR)
         
-        results = []
-        for file_name in os.listdir(title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Read necessary information
-                subject = self._read_subject_from_test(paper_id)
-                title = self._read_title_from_file(paper_id)
-                outline = self._read_outline_from_file(paper_id)
-                
-                if subject and title and outline:
-                    print(f"Found all required information for {paper_id}")
-                    abstract = self._get_abstract_from_gpt(subject, title, outline)
-                    
-                    if abstract:
-                        result = {
-                            'paper_id': paper_id,
-                            'abstract': abstract
-                        }
-                        results.append(result)
-                        self._save_abstract(paper_id, abstract)
-                        print(f"Generated abstract for {paper_id}")
-                else:
-                    print(f"Warning: Missing information for {paper_id}")
-                    if not subject:
-                        print("- Missing subject")
-                    if not title:
-                        print("- Missing title")
-                    if not outline:
-                        print("- Missing outline")
+        # 每篇论文的耗时几乎都在GPT请求上，多篇论文并发处理，各自完成后立即保存
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = [result for result in executor.map(self.process_one, paper_ids) if result]
                 
         return results
 
 def main():
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING"))
     agent = AbstractAgent()
     agent.process_papers()
-    print("\nAbstract generation completed!")
+    logger.info("Abstract generation completed!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
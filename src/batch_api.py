@@ -0,0 +1,61 @@
+"""
+Batch API helper - Submits many chat completion requests as one OpenAI batch job
+"""
+
+import json
+import time
+from typing import Dict, List, Tuple
+from config import client, model_name
+
+# batch任务的终止状态
+_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def run_batch(requests: List[Tuple[str, List[Dict]]], poll_interval: int = 30, **body) -> Dict[str, str]:
+    """Run (custom_id, messages) requests through the Batch API and return the replies by custom_id"""
+    if not requests:
+        return {}
+
+    # 每个请求一行JSONL，body里的其他参数（如temperature）对所有请求相同
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model_name, "messages": messages, **body}
+        }, ensure_ascii=False)
+        for custom_id, messages in requests
+    ]
+    batch_file = client.files.create(
+        file=('requests.jsonl', '\n'.join(lines).encode('utf-8')),
+        purpose='batch'
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+    print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+    while batch.status not in _FINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id}: {batch.status}")
+
+    # expired/cancelled的batch里已完成的请求仍在输出文件中，照样收集；
+    # 没有输出文件（如全部失败）时返回空dict，缺失的请求由调用方改用同步请求
+    if batch.status != 'completed':
+        print(f"Warning: Batch {batch.id} finished with status {batch.status}, collecting finished replies")
+    replies = {}
+    if not batch.output_file_id:
+        print(f"Warning: Batch {batch.id} has no output file")
+        return replies
+
+    # 只收集成功的响应，失败的请求由调用方自行重试
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get('response') or {}
+        if response.get('status_code') == 200:
+            replies[record['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+    return replies
@@ -5,94 +5,168 @@ Content Generation Agent - Generates detailed content for each subsection
 import os
 import json
 import re
-from typing import List, Dict, Tuple
-import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from config import client, model_name
+from llm_cache import LLMCache
+from utils import load_json, dump_json, load_prompts, list_paper_ids, strip_tag
+from paper_store import PaperStore
+from paper_info import PaperInfo
+
+# 预编译正则，避免每次调用都在re的内部缓存里查找
+_CITE_RE = re.compile(r'\[\d+\]')
+_CONTENT_RE = re.compile(r'(?s)\A\s*<content>(.*?)</content>\s*\Z')
+_CONTENT_BLOCK_RE = re.compile(r'<content id="(\d+)">(.*?)</content>', re.S)
+
+# 这些section不生成正文
+_SKIP_SECTIONS = frozenset({'Introduction', 'Conclusion'})
+
+_CORRECTION_MESSAGE = (
+    "Please format your response properly:\n"
+    "1. Wrap content in <content> tags\n"
+    "2. Write at least 3 paragraphs\n"
+    "3. Include at least 500 words\n"
+    "4. Use proper citations [n]\n"
+    "5. Don't include any headings\n"
+    "6. Maintain academic style"
+)
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+_REFERENCES_DIR = os.path.join(_BASE_DIR, 'references')
+_SUBSECTIONS_DIR = os.path.join(_BASE_DIR, 'subsections')
+_CONTENT_DIR = os.path.join(_BASE_DIR, 'content')
+
+# 每个subsection的内容预留的输出token数
+_SUBSECTION_MAX_TOKENS = 2000
+
+def _strip_content_tags(content: str) -> str:
+    """Return the text inside the <content> tags, or the whole reply if they are missing"""
+    match = _CONTENT_RE.match(content)
+    return (match.group(1) if match else content).strip()
+
+def _paper_files(paper_id: str) -> Tuple[str, ...]:
+    """Return the input files that make up a paper's information"""
+    return (
+        os.path.join(_TEST_DIR, f'{paper_id}.txt'),
+        os.path.join(_TITLE_DIR, f'{paper_id}.json'),
+        os.path.join(_OUTLINE_DIR, f'{paper_id}.json'),
+        os.path.join(_REFERENCES_DIR, f'{paper_id}.json'),
+        os.path.join(_SUBSECTIONS_DIR, f'{paper_id}.json'),
+    )
+
+# _paper_files中json文件对应的PaperStore kind
+_PAPER_KINDS = ('title', 'outline', 'references', 'subsections')
+
+def _read_subject(test_file: str) -> str:
+    """Read the subject line from a test file"""
+    with open(test_file, 'r', encoding='utf-8') as f:
+        # 逐行读取，找到subject就停，不必把整个文件读进内存
+        for line in f:
+            if line.strip() and line.strip() != "Subjects:":
+                if not line.startswith(('References:', 'Number:', 'Title:', 'Abstract:')):
+                    return line.strip()
+    raise ValueError(f"No subject found in {test_file}")
+
+def _build_paper_info(subject: str, title_data: Dict, outline_data: Dict,
+                      section_refs: Dict, subsections_data: Dict) -> PaperInfo:
+    """Assemble the paper information used by the content prompts"""
+    sections = [s for s in outline_data.get('sections', []) if s and not s.startswith(('<outline>', '</outline>'))]
+    return PaperInfo(
+        subject=subject,
+        title=strip_tag(title_data.get('title', ''), 'title'),
+        outline=sections,
+        section_refs=section_refs,
+        subsections=subsections_data.get('sections', {}),
+        # prompt里用到的拼接字符串每篇论文只算一次，所有subsection共用
+        outline_str='\n'.join(sections),
+        section_refs_str={section: '\n'.join(refs) for section, refs in section_refs.items()}
+    )
+
+# mtimes是缓存key的一部分，输入文件有改动时自动失效重新读取；
+# 只为重试和重复读取保留最近的少量论文，内存占用不随论文总数增长，旧mtime的条目也会被淘汰
+@lru_cache(maxsize=32)
+def _load_paper_bundle(paper_id: str, mtimes: Tuple[int, ...]) -> PaperInfo:
+    """Read and assemble all information for a paper"""
+    test_file, *json_files = _paper_files(paper_id)
+    return _build_paper_info(_read_subject(test_file), *map(load_json, json_files))
 
 class ContentAgent:
-    def __init__(self):
+    def __init__(self, use_cache: bool = True, store: Optional[PaperStore] = None):
         """Initialize the Content Generation Agent"""
         print("Initializing ContentAgent...")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
         print(f"Loading prompt from: {prompt_file}")
         self.prompt = self._load_prompt(prompt_file)
+        self.batch_prompt = self._load_prompt(prompt_file, 'content_batch_prompt')
         
         # 创建content输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'content')
+        self.output_dir = _CONTENT_DIR
         os.makedirs(self.output_dir, exist_ok=True)
         print(f"Output directory: {self.output_dir}")
         
-        # 设置最大重试次数
+        # 设置最大重试次数（格式不合格时重新生成的次数）
         self.max_retries = 3
+        
+        # 429/5xx/连接错误交给openai SDK自带的指数退避（带抖动）重试
+        self.client = client.with_options(max_retries=5)
+        
+        # 同一篇论文的所有section并发请求GPT的最大线程数
+        self.max_workers = 16
+        
+        # 模型单次回复的输出token上限，合并请求的max_tokens不超过它
+        self.max_output_tokens = 4096
+        
+        # 同一section的subsection合并成一次请求，每次最多合并的数量由输出token上限决定；
+        # 为1时每个subsection单独请求
+        self.batch_size = max(1, self.max_output_tokens // _SUBSECTION_MAX_TOKENS)
+        
+        # 通过格式校验的响应按prompt缓存，重跑时相同的prompt不再请求GPT
+        self.cache = LLMCache(f'content:{model_name}') if use_cache else None
+        
+        # 流水线中前面agent共享的内存store；单独运行时为None，走按mtime缓存的磁盘读取
+        self.store = store
 
-    def _load_prompt(self, prompt_file: str) -> str:
+    def _load_prompt(self, prompt_file: str, key: str = 'content_prompt') -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'content_prompt' not in prompt_data:
-                    raise KeyError("'content_prompt' not found in YAML file")
-                print("Prompt loaded successfully")
-                return prompt_data['content_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if key not in prompt_data:
+                raise KeyError(f"'{key}' not found in YAML file")
+            print("Prompt loaded successfully")
+            return prompt_data[key]
         except Exception as e:
             print(f"Error loading prompt file: {e}")
             raise
 
-    def _read_paper_info(self, paper_id: str) -> Dict:
+    def _read_paper_info(self, paper_id: str) -> Optional[PaperInfo]:
         """Read all necessary information for a paper"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            paper_info = {}
-
-            # Read subject
-            test_file = os.path.join(current_dir, 'test', f'{paper_id}.txt')
-            with open(test_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                for line in content.split('\n'):
-                    if line.strip() and line.strip() != "Subjects:":
-                        if not line.startswith(('References:', 'Number:', 'Title:', 'Abstract:')):
-                            paper_info['subject'] = line.strip()
-                            break
-
-            # Read title
-            title_file = os.path.join(current_dir, 'title', f'{paper_id}.json')
-            with open(title_file, 'r', encoding='utf-8') as f:
-                title_data = json.load(f)
-                paper_info['title'] = re.sub(r'<title>|</title>', '', title_data.get('title', '')).strip()
-
-            # Read outline
-            outline_file = os.path.join(current_dir, 'outline', f'{paper_id}.json')
-            with open(outline_file, 'r', encoding='utf-8') as f:
-                outline_data = json.load(f)
-                sections = [s for s in outline_data.get('sections', []) 
-                          if not (s.startswith('<outline>') or s.startswith('</outline>') or s == "")]
-                paper_info['outline'] = sections
-
-            # Read section references
-            refs_file = os.path.join(current_dir, 'references', f'{paper_id}.json')
-            with open(refs_file, 'r', encoding='utf-8') as f:
-                paper_info['section_refs'] = json.load(f)
-
-            # Read subsections
-            subsections_file = os.path.join(current_dir, 'subsections', f'{paper_id}.json')
-            with open(subsections_file, 'r', encoding='utf-8') as f:
-                subsections_data = json.load(f)
-                paper_info['subsections'] = subsections_data.get('sections', {})
-
-            return paper_info
+            if self.store is not None:
+                test_file, *json_files = _paper_files(paper_id)
+                docs = [self.store.load(paper_id, kind, path) for kind, path in zip(_PAPER_KINDS, json_files)]
+                return _build_paper_info(_read_subject(test_file), *docs)
+            mtimes = tuple(os.stat(path).st_mtime_ns for path in _paper_files(paper_id))
+            # PaperInfo不可变，缓存的实例可以直接共享
+            return _load_paper_bundle(paper_id, mtimes)
         except Exception as e:
             print(f"Error reading paper info: {e}")
-            return {}
+            return None
 
     def _verify_content_format(self, content: str) -> bool:
         """Verify if the content meets the requirements"""
-        if not (content.startswith('<content>') and content.endswith('</content>')):
+        match = _CONTENT_RE.match(content)
+        if not match:
             print("Content format verification failed: Missing tags")
             return False
 
         # Remove tags and analyze content
-        text = content[9:-10].strip()  # Remove <content> tags
+        text = match.group(1)  # Remove <content> tags
         
         # Count paragraphs (separated by double newlines)
         paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
@@ -107,57 +181,48 @@ class ContentAgent:
             return False
 
         # Check for citation format [n]
-        if not re.search(r'\[\d+\]', text):
+        if not _CITE_RE.search(text):
             print("Content format verification failed: No citations found")
             return False
 
         print(f"Content format verification passed: {len(paragraphs)} paragraphs, {words} words")
         return True
 
-    def _get_content(self, paper_info: Dict, section: str, subsection: str) -> str:
+    def _get_content(self, paper_info: PaperInfo, section: str, subsection: str) -> str:
         """Generate content for a subsection"""
         try:
             print(f"\nGenerating content for subsection: {subsection}")
-            section_refs = paper_info['section_refs'].get(section, [])
             formatted_prompt = self.prompt.format(
-                subject=paper_info['subject'],
-                title=paper_info['title'],
-                outline='\n'.join(paper_info['outline']),
+                subject=paper_info.subject,
+                title=paper_info.title,
+                outline=paper_info.outline_str,
                 section_heading=section,
                 subsec_heading=subsection,
-                section_refs='\n'.join(section_refs)
+                section_refs=paper_info.section_refs_str.get(section, '')
             )
+            if self.cache is not None:
+                cached = self.cache.get(formatted_prompt)
+                if cached is not None:
+                    print(f"Using cached content for subsection: {subsection}")
+                    return cached
             messages = [{"role": "user", "content": formatted_prompt}]
             
             retry_count = 0
             while retry_count < self.max_retries:  # 限制重试次数
                 print(f"Attempt {retry_count + 1}/{self.max_retries}")
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=2000
-                )
-                content = response.choices[0].message.content.strip()
+                content = self._single_call(messages)
                 print(f"Received response of length: {len(content)}")
                 
                 if self._verify_content_format(content):
+                    if self.cache is not None:
+                        self.cache.put(formatted_prompt, content)
                     return content
                 
-                correction_message = (
-                    "Please format your response properly:\n"
-                    "1. Wrap content in <content> tags\n"
-                    "2. Write at least 3 paragraphs\n"
-                    "3. Include at least 500 words\n"
-                    "4. Use proper citations [n]\n"
-                    "5. Don't include any headings\n"
-                    "6. Maintain academic style"
-                )
-                
-                messages.extend([
-                    {"role": "assistant", "content": content},
-                    {"role": "user", "content": correction_message}
-                ])
+                # 重试时只发送原prompt加一段简短的格式提醒，不再累积之前的回答，避免prompt越来越长
+                messages = [{
+                    "role": "user",
+                    "content": f"{formatted_prompt}\n\nIMPORTANT: {_CORRECTION_MESSAGE}"
+                }]
                 print("Incorrect format detected, requesting correction...")
                 retry_count += 1
             
@@ -169,50 +234,170 @@ class ContentAgent:
             print(f"Error getting GPT response: {e}")
             return ""
 
-    def _save_content(self, paper_id: str, content_data: Dict):
+    def _single_call(self, messages: List[Dict], max_tokens: int = _SUBSECTION_MAX_TOKENS) -> str:
+        """Send one chat completion request and return the stripped reply"""
+        response = self.client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content.strip()
+
+    def _get_section_contents(self, paper_info: PaperInfo, section: str, subsections: List[str]) -> Dict[str, str]:
+        """Generate content for several subsections of a section in one request"""
+        if len(subsections) == 1:
+            return {subsections[0]: self._get_content(paper_info, section, subsections[0])}
+        
+        contents = {}
+        try:
+            print(f"\nGenerating content for {len(subsections)} subsections of section: {section}")
+            formatted_prompt = self.batch_prompt.format(
+                subject=paper_info.subject,
+                title=paper_info.title,
+                outline=paper_info.outline_str,
+                section_heading=section,
+                subsec_headings='\n'.join(f'{i}. {s}' for i, s in enumerate(subsections, 1)),
+                section_refs=paper_info.section_refs_str.get(section, '')
+            )
+            response_text = self.cache.get(formatted_prompt) if self.cache is not None else None
+            if response_text is None:
+                response_text = self._single_call(
+                    [{"role": "user", "content": formatted_prompt}],
+                    max_tokens=min(_SUBSECTION_MAX_TOKENS * len(subsections), self.max_output_tokens)
+                )
+                print(f"Received response of length: {len(response_text)}")
+            
+            # 按id拆出每个subsection的内容，逐块做格式校验
+            for block_id, text in _CONTENT_BLOCK_RE.findall(response_text):
+                index = int(block_id) - 1
+                if 0 <= index < len(subsections):
+                    content = f"<content>\n{text.strip()}\n</content>"
+                    if self._verify_content_format(content):
+                        contents[subsections[index]] = content
+            if self.cache is not None and len(contents) == len(subsections):
+                self.cache.put(formatted_prompt, response_text)
+        except Exception as e:
+            print(f"Error getting GPT response: {e}")
+        
+        # 缺失或校验失败的subsection单独重新请求
+        for subsection in subsections:
+            if subsection not in contents:
+                contents[subsection] = self._get_content(paper_info, section, subsection)
+        return contents
+
+    def _partial_file(self, paper_id: str) -> str:
+        """Path of the append-only file holding finished subsections of a paper"""
+        return os.path.join(self.output_dir, f'{paper_id}.partial.jsonl')
+
+    def _load_partial(self, paper_id: str) -> Dict[Tuple[str, str], str]:
+        """Load subsections finished by an earlier, interrupted run"""
+        done = {}
+        partial_file = self._partial_file(paper_id)
+        try:
+            line = ''
+            with open(partial_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 中断时写了一半的行直接丢弃
+                    done[(record['section'], record['subsection'])] = record['content']
+            if line and not line.endswith('\n'):
+                # 补上换行，避免后续追加的记录接在半行后面
+                with open(partial_file, 'a', encoding='utf-8') as f:
+                    f.write('\n')
+        except FileNotFoundError:
+            pass
+        return done
+
+    def _save_content(self, paper_id: str, content_data: Dict, pretty: bool = False):
         """Save generated content to JSON file"""
         output_file = os.path.join(self.output_dir, f'{paper_id}.json')
         result = {
             'paper_id': paper_id,
             'sections': content_data
         }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        # 中间结果只给后续步骤读取，默认紧凑格式写入；dump_json先写临时文件再rename，
+        # 保证content/{paper_id}.json要么完整要么不存在
+        dump_json(result, output_file, pretty=pretty)
+        if self.store is not None:
+            self.store.put(paper_id, 'content', result)
         print(f"Saved content to: {output_file}")
 
+    def process_one(self, paper_id: str) -> None:
+        """Generate and save the content of every subsection for a single paper"""
+        print(f"\nProcessing paper: {paper_id}")
+        
+        # Read paper information
+        paper_info = self._read_paper_info(paper_id)
+        if not paper_info:
+            print(f"Skipping paper {paper_id} due to missing information")
+            return
+        
+        # 上次中断时已经生成的subsection直接复用，不再请求GPT
+        done = self._load_partial(paper_id)
+        if done:
+            print(f"Resuming with {len(done)} subsections from previous run")
+        
+        # Process each section and subsection
+        # 同一section的subsection按batch_size分组，每组一次GPT请求，全部并发提交
+        body_sections = {
+            section: subsections for section, subsections in paper_info.subsections.items()
+            if section not in _SKIP_SECTIONS
+        }
+        pairs = [
+            (section, subsection)
+            for section, subsections in body_sections.items()
+            for subsection in subsections
+        ]
+        pending = {}
+        for section, subsection in pairs:
+            if (section, subsection) not in done:
+                pending.setdefault(section, []).append(subsection)
+        jobs = [
+            (section, subsections[i:i + self.batch_size])
+            for section, subsections in pending.items()
+            for i in range(0, len(subsections), self.batch_size)
+        ]
+        
+        # 每完成一组就追加写入partial文件，崩溃后重跑可以从这里继续
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                open(self._partial_file(paper_id), 'a', encoding='utf-8') as partial:
+            futures = {
+                executor.submit(self._get_section_contents, paper_info, section, subsections): section
+                for section, subsections in jobs
+            }
+            for future in as_completed(futures):
+                section = futures[future]
+                for subsection, content in future.result().items():
+                    if content:
+                        content = _strip_content_tags(content)
+                        done[(section, subsection)] = content
+                        partial.write(json.dumps({
+                            'section': section,
+                            'subsection': subsection,
+                            'content': content
+                        }, ensure_ascii=False) + '\n')
+                        print(f"Generated content for subsection: {subsection}")
+                partial.flush()
+        
+        # 按outline原顺序组装结果
+        content_data = {}
+        for section, subsection in pairs:
+            if (section, subsection) in done:
+                content_data.setdefault(section, {})[subsection] = done[(section, subsection)]
+        
+        # Save results
+        self._save_content(paper_id, content_data)
+        os.remove(self._partial_file(paper_id))
+        print(f"Completed content generation for paper: {paper_id}")
+
     def process_papers(self) -> None:
         """Process all papers that have complete information"""
         print("\nStarting content generation process...")
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        title_dir = os.path.join(current_dir, 'title')
-        
-        for file_name in os.listdir(title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Read paper information
-                paper_info = self._read_paper_info(paper_id)
-                if not paper_info:
-                    print(f"Skipping paper {paper_id} due to missing information")
-                    continue
-                
-                # Process each section and subsection
-                content_data = {}
-                for section, subsections in paper_info['subsections'].items():
-                    if section not in ['Introduction', 'Conclusion']:
-                        section_content = {}
-                        for subsection in subsections:
-                            content = self._get_content(paper_info, section, subsection)
-                            if content:
-                                section_content[subsection] = content[9:-10].strip()  # Remove tags
-                                print(f"Generated content for subsection: {subsection}")
-                        if section_content:
-                            content_data[section] = section_content
-                
-                # Save results
-                self._save_content(paper_id, content_data)
-                print(f"Completed content generation for paper: {paper_id}")
+        for paper_id in list_paper_ids(_TITLE_DIR):
+            self.process_one(paper_id)
 
 def main():
     agent = ContentAgent()
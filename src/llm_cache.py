@@ -0,0 +1,50 @@
+"""
+LLM Response Cache - Persists verified GPT responses keyed by the exact prompt
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+from typing import Optional
+
+# 默认缓存文件放在项目根目录的cache/下
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'llm.sqlite'
+)
+
+class LLMCache:
+    def __init__(self, namespace: str, path: str = DEFAULT_CACHE_PATH):
+        """Open (or create) the cache; namespace separates models/agents"""
+        self.namespace = namespace
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # agent会在多个线程里并发读写，共用一个连接并加锁
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL)'
+            )
+            self._conn.commit()
+
+    def _key(self, prompt: str) -> str:
+        data = f"{self.namespace}\0{prompt}".encode('utf-8')
+        return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+    def get(self, prompt: str) -> Optional[str]:
+        """Return the cached response for prompt, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response FROM responses WHERE key = ?', (self._key(prompt),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, prompt: str, response: str):
+        """Store a response for prompt"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)',
+                (self._key(prompt), response)
+            )
+            self._conn.commit()
@@ -5,6 +5,8 @@ This script coordinates all the steps in the survey generation process
 
 import os
 import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import json
 
@@ -17,6 +19,8 @@ from referenceselection import ReferenceSelectionAgent
 from subsectionagent import SubsectionAgent
 from content import ContentAgent
 from outputxml import XMLPaperGenerator
+from paper_store import PaperStore
+from utils import list_paper_ids
 
 class SurveyGenerator:
     def __init__(self):
@@ -31,6 +35,12 @@ class SurveyGenerator:
         ]
         self._create_directories()
         
+        # 所有agent共享一个内存store，后面的步骤直接复用前面步骤的结果，不再重复读JSON
+        self.store = PaperStore()
+        
+        # 同时在流水线中处理的论文数，每个agent内部还会并发请求GPT
+        self.max_workers = 8
+        
     def _create_directories(self):
         """Create all required directories"""
         for dir_name in self.required_dirs:
@@ -44,6 +54,39 @@ class SurveyGenerator:
         print(f"✓ {step_name} completed in {time_taken:.2f} seconds")
         return end_time
 
+    def _create_stages(self):
+        """Create the agents for steps 2-8 in pipeline order"""
+        self.stages = [
+            ("Title generation", TitleAgent(store=self.store)),
+            ("Outline generation", OutlineAgent(store=self.store)),
+            ("Abstract generation", AbstractAgent(store=self.store)),
+            ("Reference selection", ReferenceSelectionAgent(store=self.store)),
+            ("Subsection generation", SubsectionAgent(store=self.store)),
+            ("Content generation", ContentAgent(store=self.store)),
+            ("XML generation", XMLPaperGenerator(store=self.store)),
+        ]
+
+    def _close_stages(self):
+        """Shut down the thread pools of the agents that own one"""
+        for step_name, agent in self.stages:
+            if hasattr(agent, 'close'):
+                agent.close()
+
+    def _pipeline_one(self, paper_id: str):
+        """Run steps 2-8 for a single paper"""
+        start_time = time.time()
+        try:
+            for step_name, agent in self.stages:
+                agent.process_one(paper_id)
+        except Exception as e:
+            # 单篇论文失败不影响其他论文
+            print(f"\n❌ Error during survey generation for {paper_id} ({step_name}): {str(e)}")
+            return
+        finally:
+            # 这篇论文的中间结果都已写到磁盘，从共享store中移除
+            self.store.drop(paper_id)
+        print(f"✓ {paper_id} completed in {time.time() - start_time:.2f} seconds")
+
     def generate_survey(self):
         """Run the complete survey generation process"""
         total_start_time = time.time()
@@ -55,47 +98,17 @@ class SurveyGenerator:
             process_all_json_files_and_save_txt('train', 'test')
             start_time = self._log_step("Train file processing", start_time)
 
-            # Step 2: Generate titles
-            print("\n2. Generating titles...")
-            title_agent = TitleAgent()
-            title_agent.process_folder()
-            start_time = self._log_step("Title generation", start_time)
-
-            # Step 3: Generate outlines
-            print("\n3. Generating outlines...")
-            outline_agent = OutlineAgent()
-            outline_agent.process_folder()
-            start_time = self._log_step("Outline generation", start_time)
-
-            # Step 4: Generate abstracts
-            print("\n4. Generating abstracts...")
-            abstract_agent = AbstractAgent()
-            abstract_agent.process_papers()
-            start_time = self._log_step("Abstract generation", start_time)
-
-            # Step 5: Select references
-            print("\n5. Selecting references...")
-            reference_agent = ReferenceSelectionAgent()
-            reference_agent.process_papers()
-            start_time = self._log_step("Reference selection", start_time)
-
-            # Step 6: Generate subsections
-            print("\n6. Generating subsections...")
-            subsection_agent = SubsectionAgent()
-            subsection_agent.process_papers()
-            start_time = self._log_step("Subsection generation", start_time)
-
-            # Step 7: Generate content
-            print("\n7. Generating content...")
-            content_agent = ContentAgent()
-            content_agent.process_papers()
-            start_time = self._log_step("Content generation", start_time)
-
-            # Step 8: Generate final XML
-            print("\n8. Generating final XML...")
-            xml_generator = XMLPaperGenerator()
-            xml_generator.process_papers()
-            final_time = self._log_step("XML generation", start_time)
+            # Steps 2-8: 每篇论文依次走完所有步骤，多篇论文并发处理
+            print("\n2-8. Generating titles, outlines, abstracts, references, subsections, content and XML per paper...")
+            test_dir = os.path.join(self.base_dir, 'test')
+            paper_ids = list_paper_ids(test_dir, '.txt')
+            self._create_stages()
+            try:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    list(executor.map(self._pipeline_one, paper_ids))
+            finally:
+                self._close_stages()
+            final_time = self._log_step(f"Survey generation for {len(paper_ids)} papers", start_time)
 
             # Print summary
             total_time = final_time - total_start_time
@@ -103,7 +116,8 @@ class SurveyGenerator:
             print(f"Generated files can be found in the following directories:")
             for dir_name in self.required_dirs:
                 dir_path = os.path.join(self.base_dir, dir_name)
-                file_count = len([f for f in os.listdir(dir_path) if not f.startswith('.')])
+                with os.scandir(dir_path) as entries:
+                    file_count = sum(1 for entry in entries if not entry.name.startswith('.'))
                 print(f"  - {dir_name}/: {file_count} files")
 
         except Exception as e:
@@ -111,6 +125,8 @@ class SurveyGenerator:
             raise
 
 def main():
+    # 各agent通过logging输出过程信息，默认只显示WARNING及以上
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING"))
     print("Starting survey generation process...")
     generator = SurveyGenerator()
     generator.generate_survey()
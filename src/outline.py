@@ -3,32 +3,47 @@ Outline Generation Agent - Generates survey paper outline based on references
 """
 
 import os
-import json
 import re
-from typing import List, Dict, Tuple
-import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Dict, Optional, Tuple
 from config import client, model_name
+from utils import dump_json, load_prompts, list_paper_ids
+from paper_store import PaperStore
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+
+def _split_sections(text: str) -> List[str]:
+    """Split an outline response into its stripped, non-empty lines"""
+    return [s for s in map(str.strip, text.split('\n')) if s]
 
 class OutlineAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the Outline Agent"""
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
         self.prompt = self._load_prompt(prompt_file)
         
         # 创建outline输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'outline')
+        self.output_dir = _OUTLINE_DIR
         os.makedirs(self.output_dir, exist_ok=True)
         
+        # 多个文件并发请求GPT的最大线程数
+        self.max_workers = 16
+        
+        # 与后续agent共享的内存store，保存的结果同时放进去
+        self.store = store if store is not None else PaperStore()
+        
     def _load_prompt(self, prompt_file: str) -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'outline_prompt' not in prompt_data:
-                    print(f"Warning: 'outline_prompt' not found in {prompt_file}")
-                    return self._get_default_prompt()
-                return prompt_data['outline_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if 'outline_prompt' not in prompt_data:
+                print(f"Warning: 'outline_prompt' not found in {prompt_file}")
+                return self._get_default_prompt()
+            return prompt_data['outline_prompt']
         except Exception as e:
             print(f"Error loading prompt file: {e}")
             return self._get_default_prompt()
@@ -57,9 +72,8 @@ Conclusion
 </outline>
 """
 
-    def _extract_content(self, file_content: str) -> Tuple[str, str]:
-        """Extract subject and references from the file content"""
-        lines = file_content.split('\n')
+    def _extract_content(self, lines: Iterable[str]) -> Tuple[str, str]:
+        """Extract subject and references from the lines of a file"""
         subject = ""
         references = []
         current_section = ""
@@ -83,9 +97,9 @@ Conclusion
     def _read_reference_file(self, file_path: str) -> Dict:
         """Read and parse a single reference file"""
         try:
+            # 直接逐行解析文件对象，不再先读成一个大字符串再split
             with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            subject, references = self._extract_content(content)
+                subject, references = self._extract_content(f)
             return {
                 'id': os.path.splitext(os.path.basename(file_path))[0],
                 'subject': subject,
@@ -95,14 +109,12 @@ Conclusion
             print(f"Error reading file {file_path}: {e}")
             return {}
 
-    def _verify_outline_format(self, outline: str) -> bool:
+    def _verify_outline_format(self, sections: List[str]) -> bool:
         """Verify if the outline format is acceptable"""
-        content = outline.strip()
         # 输出包含6-10个section就可以了
-        sections = [s.strip() for s in content.split('\n') if s.strip()]
         return 6 <= len(sections) <= 10
 
-    def _get_outline_from_gpt(self, subject: str, references: str) -> str:
+    def _get_outline_from_gpt(self, subject: str, references: str) -> List[str]:
         """Get outline suggestion from GPT"""
         try:
             formatted_prompt = self.prompt.format(
@@ -118,9 +130,9 @@ Conclusion
             )
             outline = response.choices[0].message.content.strip()
 
-            # 简单提取section列表
-            sections = [s.strip() for s in outline.split('\n') if s.strip()]
-            if not (6 <= len(sections) <= 10):
+            # 简单提取section列表，之后保存和打印都复用这个列表
+            sections = _split_sections(outline)
+            if not self._verify_outline_format(sections):
                 correction_message = (
                     "Please provide between 6 and 10 sections (excluding Introduction and Conclusion). "
                     "Each section should be on a new line."
@@ -135,62 +147,59 @@ Conclusion
                     temperature=0.7
                 )
                 outline = response.choices[0].message.content.strip()
+                sections = _split_sections(outline)
                 
-            return outline
+            return sections
                 
         except Exception as e:
             print(f"Error getting GPT response: {e}")
-            return ""
+            return []
 
-    def _save_outline(self, paper_id: str, outline: str):
+    def _save_outline(self, paper_id: str, sections: List[str], pretty: bool = False):
         """Save outline to individual JSON file"""
         output_file = os.path.join(self.output_dir, f'{paper_id}.json')
         
-        # Extract sections from the outline
-        sections = [s.strip() for s in outline.split('\n') if s.strip()]
-        
         result = {
             'paper_id': paper_id,
             'sections': sections
         }
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        # 中间结果只给后续步骤读取，默认紧凑格式写入
+        dump_json(result, output_file, pretty=pretty)
+        self.store.put(paper_id, 'outline', result)
+
+    def process_one(self, paper_id: str) -> Dict[str, List[str]]:
+        """Generate and save the outline for a single paper"""
+        file_path = os.path.join(_TEST_DIR, f'{paper_id}.txt')
+        ref_data = self._read_reference_file(file_path)
+        
+        if ref_data and ref_data.get('subject') and ref_data.get('references'):
+            print(f"\nProcessing {ref_data['id']}...")
+            sections = self._get_outline_from_gpt(ref_data['subject'], ref_data['references'])
+            
+            # 保存单独的JSON文件
+            self._save_outline(ref_data['id'], sections)
+            
+            print(f"Generated outline for {ref_data['id']}:")
+            for section in sections:
+                print(f"  {section}")
+            return {
+                'paper_id': ref_data['id'],
+                'sections': sections
+            }
+        print(f"Warning: Missing subject or references for {file_path}")
+        return {}
 
     def process_folder(self) -> List[Dict[str, List[str]]]:
         """Process all txt files in the test folder"""
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        test_folder = os.path.join(current_dir, 'test')
+        paper_ids = list_paper_ids(_TEST_DIR, '.txt')
         
-        results = []
-        for file_name in os.listdir(test_folder):
-            if file_name.endswith('.txt'):
-                file_path = os.path.join(test_folder, file_name)
-                ref_data = self._read_reference_file(file_path)
-                
-                if ref_data and ref_data.get('subject') and ref_data.get('references'):
-                    print(f"\nProcessing {ref_data['id']}...")
-                    outline = self._get_outline_from_gpt(ref_data['subject'], ref_data['references'])
-                    
-                    # Extract sections
-                    sections = [s.strip() for s in outline.split('\n') if s.strip()]
-                    
-                    result = {
-                        'paper_id': ref_data['id'],
-                        'sections': sections
-                    }
-                    results.append(result)
-                    
-                    # 保存单独的JSON文件
-                    self._save_outline(ref_data['id'], outline)
-                    
-                    print(f"Generated outline for {ref_data['id']}:")
-                    for section in sections:
-                        print(f"  {section}")
-                else:
-                    print(f"Warning: Missing subject or references for {file_path}")
-
-        return results
+        # 先提交所有文件的任务再统一收集结果，避免在提交循环里等待result()退化成串行
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.process_one, paper_id) for paper_id in paper_ids]
+            results = [future.result() for future in futures]
+
+        return [result for result in results if result]
 
 def main():
     agent = OutlineAgent()
@@ -3,12 +3,16 @@ XML Paper Generator - Combines all generated content into a final XML paper
 """
 
 import os
-import json
-import re
-from typing import Dict, List
+import argparse
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from xml.sax.saxutils import escape
+from typing import Dict, List, Optional
+from paper_store import PaperStore
+from utils import load_json, list_paper_ids, pending_paper_ids, strip_tag
 
 class XMLPaperGenerator:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the XML Paper Generator"""
         print("Initializing XMLPaperGenerator...")
         current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -26,14 +30,23 @@ class XMLPaperGenerator:
         self.output_dir = os.path.join(base_dir, 'final')
         os.makedirs(self.output_dir, exist_ok=True)
         print(f"Output directory: {self.output_dir}")
+        
+        # 前面agent生成的结果优先从内存store读取，没有时再读磁盘
+        self.store = store if store is not None else PaperStore()
+        
+        # 论文数超过阈值时用多进程并行生成，论文很少时进程池的启动开销不划算
+        self.max_workers = os.cpu_count()
+        self.parallel_threshold = 4
+        
+        # 一篇论文的6个输入文件同时读取，文件系统可以重叠处理这些请求
+        self.read_executor = ThreadPoolExecutor(max_workers=6)
 
     def _read_title(self, paper_id: str) -> str:
         """Read title from json file"""
         try:
-            with open(os.path.join(self.title_dir, f'{paper_id}.json'), 'r') as f:
-                data = json.load(f)
-                title = data.get('title', '')
-                return re.sub(r'<title>|</title>', '', title).strip()
+            data = self.store.load(paper_id, 'title', os.path.join(self.title_dir, f'{paper_id}.json'))
+            title = data.get('title', '')
+            return strip_tag(title, 'title')
         except Exception as e:
             print(f"Error reading title: {e}")
             return ""
@@ -41,10 +54,9 @@ class XMLPaperGenerator:
     def _read_abstract(self, paper_id: str) -> str:
         """Read abstract from json file"""
         try:
-            with open(os.path.join(self.abstract_dir, f'{paper_id}.json'), 'r') as f:
-                data = json.load(f)
-                abstract = data.get('abstract', '')
-                return re.sub(r'<abstract>|</abstract>', '', abstract).strip()
+            data = self.store.load(paper_id, 'abstract', os.path.join(self.abstract_dir, f'{paper_id}.json'))
+            abstract = data.get('abstract', '')
+            return strip_tag(abstract, 'abstract')
         except Exception as e:
             print(f"Error reading abstract: {e}")
             return ""
@@ -52,11 +64,9 @@ class XMLPaperGenerator:
     def _read_sections(self, paper_id: str) -> List[str]:
         """Read main sections from outline"""
         try:
-            with open(os.path.join(self.outline_dir, f'{paper_id}.json'), 'r') as f:
-                data = json.load(f)
-                sections = [s for s in data.get('sections', []) 
-                          if not (s.startswith('<outline>') or s.startswith('</outline>'))]
-                return sections
+            data = self.store.load(paper_id, 'outline', os.path.join(self.outline_dir, f'{paper_id}.json'))
+            sections = [s for s in data.get('sections', []) if not s.startswith(('<outline>', '</outline>'))]
+            return sections
         except Exception as e:
             print(f"Error reading sections: {e}")
             return []
@@ -64,9 +74,8 @@ class XMLPaperGenerator:
     def _read_subsections(self, paper_id: str) -> Dict[str, List[str]]:
         """Read subsections for each section"""
         try:
-            with open(os.path.join(self.subsections_dir, f'{paper_id}.json'), 'r') as f:
-                data = json.load(f)
-                return data.get('sections', {})
+            data = self.store.load(paper_id, 'subsections', os.path.join(self.subsections_dir, f'{paper_id}.json'))
+            return data.get('sections', {})
         except Exception as e:
             print(f"Error reading subsections: {e}")
             return {}
@@ -74,9 +83,8 @@ class XMLPaperGenerator:
     def _read_content(self, paper_id: str) -> Dict[str, Dict[str, str]]:
         """Read content for each subsection"""
         try:
-            with open(os.path.join(self.content_dir, f'{paper_id}.json'), 'r') as f:
-                data = json.load(f)
-                return data.get('sections', {})
+            data = self.store.load(paper_id, 'content', os.path.join(self.content_dir, f'{paper_id}.json'))
+            return data.get('sections', {})
         except Exception as e:
             print(f"Error reading content: {e}")
             return {}
@@ -86,122 +94,168 @@ class XMLPaperGenerator:
         try:
             # 构建完整的文件名（需要添加train前缀）
             train_file = os.path.join(self.train_dir, f'train{paper_id}.content.ref.json')
-            with open(train_file, 'r') as f:
-                data = json.load(f)
-                
-                # 提取reference和reference_content
-                references = data.get('reference', [])
-                reference_contents = data.get('reference_content', [])
-                
-                # 创建完整的参考文献列表
-                ref_list = references
-                
-                # 如果有abstract，添加到对应的参考文献中
-                if reference_contents:
-                    # 创建一个映射，用于快速查找reference_content
-                    content_map = {
-                        item['reference_num']: item.get('reference_abstract', '')
-                        for item in reference_contents
-                    }
-                    
-                    # 对每个参考文献，如果有abstract，就添加到后面
-                    ref_list_with_abstracts = []
-                    for ref in references:
-                        ref_num = f"[{len(ref_list_with_abstracts) + 1}]"
-                        if ref_num in content_map and content_map[ref_num]:
-                            ref_list_with_abstracts.append(
-                                f"{ref}\nAbstract: {content_map[ref_num]}"
-                            )
-                        else:
-                            ref_list_with_abstracts.append(ref)
-                    
-                    ref_list = ref_list_with_abstracts
-
-                return '\n\n'.join(ref_list)
+            data = load_json(train_file)
+            
+            # 提取reference和reference_content
+            references = data.get('reference', [])
+            reference_contents = data.get('reference_content', [])
+            
+            # 创建完整的参考文献列表
+            ref_list = references
+            
+            # 如果有abstract，添加到对应的参考文献中
+            if reference_contents:
+                # 创建一个映射，用于快速查找reference_content
+                content_map = {
+                    item['reference_num']: item.get('reference_abstract', '')
+                    for item in reference_contents
+                }
                 
+                # 对每个参考文献，如果有abstract，就添加到后面（编号就是在列表中的序号）
+                ref_list = [
+                    f"{ref}\nAbstract: {abstract}" if (abstract := content_map.get(f"[{i}]")) else ref
+                    for i, ref in enumerate(references, 1)
+                ]
+
+            return '\n\n'.join(ref_list)
+            
         except Exception as e:
             print(f"Error reading references: {e}")
             return ""
 
-    def _generate_xml(self, paper_id: str) -> str:
-        """Generate XML content for the paper"""
+    def _read_all(self, paper_id: str) -> Dict:
+        """Read all components of a paper concurrently"""
+        readers = {
+            'title': self._read_title,
+            'abstract': self._read_abstract,
+            'sections': self._read_sections,
+            'subsections': self._read_subsections,
+            'content': self._read_content,
+            'references': self._read_references
+        }
+        futures = {key: self.read_executor.submit(reader, paper_id) for key, reader in readers.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+    def _generate_and_save_xml(self, paper_id: str):
+        """Generate the XML for the paper and stream it to its output file"""
+        output_file = os.path.join(self.output_dir, f'{paper_id}.xml')
+        # 边生成边写入临时文件，不在内存里保留整篇XML；写完再rename，
+        # 中途中断不会留下被跳过检查当作已完成的不完整XML
+        tmp_file = output_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8', buffering=1024 * 1024) as f:
+            self._write_xml(paper_id, f.write)
+        os.replace(tmp_file, output_file)
+        print(f"Saved XML to: {output_file}")
+
+    def _write_xml(self, paper_id: str, w):
+        """Generate XML content for the paper, passing each piece to w"""
         # Read all components
-        title = self._read_title(paper_id)
-        abstract = self._read_abstract(paper_id)
-        sections = self._read_sections(paper_id)
-        subsections = self._read_subsections(paper_id)
-        content = self._read_content(paper_id)
-        references = self._read_references(paper_id)
+        parts = self._read_all(paper_id)
+        title = parts['title']
+        abstract = parts['abstract']
+        sections = parts['sections']
+        subsections = parts['subsections']
+        content = parts['content']
+        references = parts['references']
 
         # Start building XML
-        xml_content = ['<?xml version="1.0" encoding="UTF-8"?>']
-        xml_content.append('<Literature>')
+        w('<?xml version="1.0" encoding="UTF-8"?>\n')
+        w('<Literature>\n')
         
         # Add title and abstract
-        xml_content.append(f'<Title>{title}</Title>')
-        xml_content.append(f'<Abstract>{abstract}</Abstract>')
+        # 所有文本字段都做XML转义，避免&、<、>导致生成的XML无法解析
+        w(f'<Title>{escape(title)}</Title>\n')
+        w(f'<Abstract>{escape(abstract)}</Abstract>\n')
 
         # Add sections, subsections, and content
         section_num = 1
         for section in sections:
             if section not in ['Introduction', 'Conclusion']:
                 # Add section title
-                xml_content.append(f'<Section_{section_num}_title>{section}</Section_{section_num}_title>')
+                w(f'<Section_{section_num}_title>{escape(section)}</Section_{section_num}_title>\n')
                 
                 # Add subsections
                 if section in subsections:
                     subsection_num = 1
                     for subsection in subsections[section]:
                         # Add subsection title
-                        xml_content.append(
-                            f'<Section_{section_num}.{subsection_num}_title>{subsection}</Section_{section_num}.{subsection_num}_title>'
-                        )
+                        w(f'<Section_{section_num}.{subsection_num}_title>{escape(subsection)}</Section_{section_num}.{subsection_num}_title>\n')
                         
                         # Add subsection content
                         if section in content and subsection in content[section]:
-                            xml_content.append(
-                                f'<Section_{section_num}.{subsection_num}_text>{content[section][subsection]}</Section_{section_num}.{subsection_num}_text>'
-                            )
+                            w(f'<Section_{section_num}.{subsection_num}_text>{escape(content[section][subsection])}</Section_{section_num}.{subsection_num}_text>\n')
                         
                         subsection_num += 1
                         
                 section_num += 1
 
         # Add references
-        xml_content.append('<References>')
-        xml_content.append(references)
-        xml_content.append('</References>')
+        w('<References>\n')
+        w(escape(references))
+        w('\n</References>\n')
         
         # Close main tag
-        xml_content.append('</Literature>')
-        
-        return '\n'.join(xml_content)
+        w('</Literature>')
 
-    def _save_xml(self, paper_id: str, xml_content: str):
-        """Save XML content to file"""
-        output_file = os.path.join(self.output_dir, f'{paper_id}.xml')
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(xml_content)
-        print(f"Saved XML to: {output_file}")
+    def process_one(self, paper_id: str):
+        """Generate and save the XML file for a single paper"""
+        print(f"\nProcessing paper: {paper_id}")
+        
+        # Generate and save XML
+        try:
+            self._generate_and_save_xml(paper_id)
+        finally:
+            # XML是最后一步，这篇论文的结果之后不会再读，释放store中的内存
+            self.store.drop(paper_id)
+        print(f"Completed XML generation for paper: {paper_id}")
 
-    def process_papers(self):
+    def process_papers(self, skip_existing: bool = True):
         """Process all papers and generate XML files"""
         print("\nStarting XML generation process...")
         
         # Get list of paper IDs from title directory
-        for file_name in os.listdir(self.title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Generate and save XML
-                xml_content = self._generate_xml(paper_id)
-                self._save_xml(paper_id, xml_content)
-                print(f"Completed XML generation for paper: {paper_id}")
+        paper_ids = list_paper_ids(self.title_dir)
+        if skip_existing:
+            # 已经生成过XML的论文跳过
+            pending = pending_paper_ids(paper_ids, self.output_dir, '.xml')
+            print(f"Skipping {len(paper_ids) - len(pending)} papers with existing output")
+            paper_ids = pending
+        if len(paper_ids) <= self.parallel_threshold:
+            for paper_id in paper_ids:
+                self.process_one(paper_id)
+            return
+        
+        # 每篇论文互相独立，交给进程池并行处理；子进程各自创建generator并从磁盘读取
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker) as executor:
+            list(executor.map(_process_one, paper_ids, chunksize=8))
+
+    def close(self):
+        """Shut down the file reading thread pool once processing is finished"""
+        self.read_executor.shutdown()
+
+# 进程池中每个子进程持有的generator
+_worker_generator = None
+
+def _init_worker():
+    """Create the generator used by a worker process"""
+    global _worker_generator
+    _worker_generator = XMLPaperGenerator()
+    # 子进程退出时关闭generator的读取线程池
+    Finalize(_worker_generator, _worker_generator.close, exitpriority=10)
+
+def _process_one(paper_id: str):
+    """Generate and save the XML file for a single paper in a worker process"""
+    _worker_generator.process_one(paper_id)
 
 def main():
+    parser = argparse.ArgumentParser(description="Combine the generated parts into the final XML papers")
+    parser.add_argument('--force', action='store_true', help="regenerate papers that already have output")
+    args = parser.parse_args()
     generator = XMLPaperGenerator()
-    generator.process_papers()
+    try:
+        generator.process_papers(skip_existing=not args.force)
+    finally:
+        generator.close()
     print("\nXML generation completed!")
 
 if __name__ == "__main__":
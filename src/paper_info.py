@@ -0,0 +1,20 @@
+"""
+Paper Info - The per-paper inputs the section-level agents build their prompts from
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# slots避免每个实例带一个__dict__，frozen保证缓存或并发共享的实例不会被改动
+@dataclass(slots=True, frozen=True)
+class PaperInfo:
+    subject: str
+    title: str
+    outline: List[str]
+    outline_str: str
+    references: str = ''
+    section_refs: Dict[str, List[str]] = field(default_factory=dict)
+    section_refs_str: Dict[str, str] = field(default_factory=dict)
+    subsections: Dict[str, List[str]] = field(default_factory=dict)
+    # prefill_prompt返回的已填好本篇论文字段的prompt
+    prompt_parts: List[Tuple[str, Optional[str]]] = field(default_factory=list)
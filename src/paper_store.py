@@ -0,0 +1,40 @@
+"""
+Paper Store - Shares the per-paper JSON documents between pipeline stages in memory
+"""
+
+import threading
+from typing import Dict, Optional, Tuple
+from utils import load_json
+
+class PaperStore:
+    def __init__(self):
+        """Initialize an empty store"""
+        # key是(paper_id, kind)，kind对应输出目录名，如'title'、'outline'、'references'
+        self._docs: Dict[Tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+
+    def put(self, paper_id: str, kind: str, doc: dict):
+        """Remember the document a stage just wrote for a paper"""
+        with self._lock:
+            self._docs[(paper_id, kind)] = doc
+
+    def get(self, paper_id: str, kind: str) -> Optional[dict]:
+        """Return the stored document, or None if no stage has stored it"""
+        with self._lock:
+            return self._docs.get((paper_id, kind))
+
+    def drop(self, paper_id: str):
+        """Forget every document stored for a paper"""
+        # 论文处理完后调用，store的内存占用不随论文总数增长
+        with self._lock:
+            for key in [key for key in self._docs if key[0] == paper_id]:
+                del self._docs[key]
+
+    def load(self, paper_id: str, kind: str, path: str) -> dict:
+        """Return the stored document, reading it from path on a miss"""
+        doc = self.get(paper_id, kind)
+        if doc is None:
+            # 磁盘上的文件仍然保留，单独运行某个agent时从这里回退读取
+            doc = load_json(path)
+            self.put(paper_id, kind, doc)
+        return doc
@@ -3,127 +3,156 @@ Reference Selection Agent - Selects relevant references for each section
 """
 
 import os
-import json
+import argparse
 import re
-from typing import List, Dict, Tuple
-import yaml
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from config import client, model_name
+from paper_store import PaperStore
+from paper_info import PaperInfo
+from batch_api import run_batch
+from utils import dump_json, load_prompts, list_paper_ids, pending_paper_ids, prefill_prompt, fill_prompt, strip_tag
+
+# 预编译正则，避免每次调用都在re的内部缓存里查找
+_REF_LINE_RE = re.compile(r'\[\d+\]')
+# 第一组是Subjects:到References:之间的整块，第二组是每一行Title:的内容
+_PARSE_RE = re.compile(r'^Subjects:[ \t]*\n(?s:(.*?))^References:[ \t]*$|^Title:[ \t]*(.*)$', re.MULTILINE)
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+_REFERENCES_DIR = os.path.join(_BASE_DIR, 'references')
+
+# 校验只依赖字符串本身，模型重复返回同样的错误格式时直接用缓存结果
+@lru_cache(maxsize=128)
+def _verify_refs_format(refs: str) -> bool:
+    """Verify if the references are in correct format"""
+    if not (refs.startswith('<refs>') and refs.endswith('</refs>')):
+        print("References format verification failed: Missing tags")
+        return False
+        
+    content = refs[6:-7].strip()  # Remove tags
+    lines = [line.strip() for line in content.split('\n') if line.strip()]
+    
+    # Check if each line starts with * and contains [number]
+    for line in lines:
+        if not (line.startswith('*') and _REF_LINE_RE.search(line)):
+            print(f"References format verification failed: Invalid line format: {line}")
+            return False
+    
+    print("References format verification passed")
+    return True
 
 class ReferenceSelectionAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the Reference Selection Agent"""
         print("Initializing ReferenceSelectionAgent...")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
         print(f"Loading prompt from: {prompt_file}")
         self.prompt = self._load_prompt(prompt_file)
         
         # 创建reference_selection输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'references')
+        self.output_dir = _REFERENCES_DIR
         os.makedirs(self.output_dir, exist_ok=True)
         print(f"Output directory: {self.output_dir}")
+        
+        # 前面agent写入的title/outline优先从内存store读取，没有时再读磁盘
+        self.store = store if store is not None else PaperStore()
+        
+        # 同一篇论文的各个section并发请求GPT的最大线程数，以及同时处理的论文数
+        self.max_workers = 16
+        self.max_paper_workers = 4
+        # 所有论文共用一个section请求线程池，并发上限不随同时处理的论文数成倍增长
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        
+        # 格式纠正的最大请求次数
+        self.max_retries = 3
 
     def _load_prompt(self, prompt_file: str) -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'reference_selection_prompt' not in prompt_data:
-                    raise KeyError("'reference_selection_prompt' not found in YAML file")
-                print("Prompt loaded successfully")
-                return prompt_data['reference_selection_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if 'reference_selection_prompt' not in prompt_data:
+                raise KeyError("'reference_selection_prompt' not found in YAML file")
+            print("Prompt loaded successfully")
+            return prompt_data['reference_selection_prompt']
         except Exception as e:
             print(f"Error loading prompt file: {e}")
             raise
 
-    def _read_paper_info(self, paper_id: str) -> Dict:
+    def _read_paper_info(self, paper_id: str) -> Optional[PaperInfo]:
         """Read all necessary information for a paper"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            
             # Read subject and references
-            test_file = os.path.join(current_dir, 'test', f'{paper_id}.txt')
+            test_file = os.path.join(_TEST_DIR, f'{paper_id}.txt')
             with open(test_file, 'r', encoding='utf-8') as f:
                 content = f.read()
+            # 一次正则扫描同时取出Subjects块和所有Title:行，subject取块中最后一个有效行
             subject = ""
             references = []
-            current_section = ""
-            
-            for line in content.split('\n'):
-                line = line.strip()
-                if line == "Subjects:":
-                    current_section = "subjects"
-                elif line == "References:":
-                    current_section = "references"
-                elif line and current_section == "subjects" and line != "Subjects:":
-                    if not line.startswith(('References:', 'Number:', 'Title:', 'Abstract:')):
-                        subject = line
-                elif line and current_section == "references":
-                    if line.startswith('Title:'):
-                        references.append(line[6:].strip())
+            for match in _PARSE_RE.finditer(content):
+                if match.group(1) is not None:
+                    for line in match.group(1).split('\n'):
+                        line = line.strip()
+                        if line and not line.startswith(('Subjects:', 'Number:', 'Title:', 'Abstract:')):
+                            subject = line
+                else:
+                    references.append(match.group(2).strip())
             
             # Read title
-            title_file = os.path.join(current_dir, 'title', f'{paper_id}.json')
-            with open(title_file, 'r', encoding='utf-8') as f:
-                title_data = json.load(f)
-                title = re.sub(r'<title>|</title>', '', title_data.get('title', '')).strip()
+            title_file = os.path.join(_TITLE_DIR, f'{paper_id}.json')
+            title_data = self.store.load(paper_id, 'title', title_file)
+            title = strip_tag(title_data.get('title', ''), 'title')
             
             # Read outline and clean it
-            outline_file = os.path.join(current_dir, 'outline', f'{paper_id}.json')
-            with open(outline_file, 'r', encoding='utf-8') as f:
-                outline_data = json.load(f)
-                # 清理大纲，移除标签和非章节内容
-                sections = outline_data.get('sections', [])
-                cleaned_sections = []
-                for section in sections:
-                    if not (section.startswith('<outline>') or 
-                           section.startswith('</outline>') or
-                           section == ""):
-                        cleaned_sections.append(section)
+            outline_file = os.path.join(_OUTLINE_DIR, f'{paper_id}.json')
+            outline_data = self.store.load(paper_id, 'outline', outline_file)
+            # 清理大纲，移除标签和非章节内容
+            sections = outline_data.get('sections', [])
+            cleaned_sections = [
+                section for section in sections
+                if section and not section.startswith(('<outline>', '</outline>'))
+            ]
             
-            return {
-                'subject': subject,
-                'title': title,
-                'outline': cleaned_sections,
-                'references': '\n'.join(references)
-            }
+            # 大纲和参考文献每篇论文只拼接一次
+            outline_str = '\n'.join(cleaned_sections)
+            references = '\n'.join(references)
+            return PaperInfo(
+                subject=subject,
+                title=title,
+                outline=cleaned_sections,
+                outline_str=outline_str,
+                references=references,
+                # 除section外的字段对同一篇论文都相同，只填一次
+                prompt_parts=prefill_prompt(
+                    self.prompt,
+                    subject=subject,
+                    title=title,
+                    outline=outline_str,
+                    references=references
+                )
+            )
         except Exception as e:
             print(f"Error reading paper info: {e}")
-            return {}
+            return None
 
-    def _verify_refs_format(self, refs: str) -> bool:
-        """Verify if the references are in correct format"""
-        if not (refs.startswith('<refs>') and refs.endswith('</refs>')):
-            print("References format verification failed: Missing tags")
-            return False
-            
-        content = refs[6:-7].strip()  # Remove tags
-        lines = [line.strip() for line in content.split('\n') if line.strip()]
-        
-        # Check if each line starts with * and contains [number]
-        for line in lines:
-            if not (line.startswith('*') and re.search(r'\[\d+\]', line)):
-                print(f"References format verification failed: Invalid line format: {line}")
-                return False
-        
-        print("References format verification passed")
-        return True
+    def _format_prompt(self, paper_info: PaperInfo, section: str) -> str:
+        """Fill in the reference selection prompt for a section"""
+        return fill_prompt(paper_info.prompt_parts, section=section)
 
-    def _get_refs_for_section(self, paper_info: Dict, section: str) -> str:
+    def _get_refs_for_section(self, paper_info: PaperInfo, section: str) -> str:
         """Get reference selection from GPT for a specific section"""
         try:
             print(f"\nSelecting references for section: {section}")
-            formatted_prompt = self.prompt.format(
-                subject=paper_info['subject'],
-                title=paper_info['title'],
-                outline='\n'.join(paper_info['outline']),
-                section=section,
-                references=paper_info['references']
-            )
+            formatted_prompt = self._format_prompt(paper_info, section)
             messages = [{"role": "user", "content": formatted_prompt}]
             
-            while True:  # 循环直到获得正确格式的响应
-                print("Sending request to GPT...")
+            for attempt in range(self.max_retries):  # 限制重试次数
+                print(f"Attempt {attempt + 1}/{self.max_retries}")
                 response = client.chat.completions.create(
                     model=model_name,
                     messages=messages,
@@ -132,7 +161,7 @@ class ReferenceSelectionAgent:
                 refs = response.choices[0].message.content.strip()
                 print("Received response")
                 
-                if self._verify_refs_format(refs):
+                if _verify_refs_format(refs):
                     return refs
                 
                 correction_message = (
@@ -143,11 +172,16 @@ class ReferenceSelectionAgent:
                     "4. Be on a new line"
                 )
                 
-                messages.extend([
+                # 只保留原prompt和最近一次回答，不累积之前的对话，避免每次重试的上下文越来越长
+                messages = [
+                    {"role": "user", "content": formatted_prompt},
                     {"role": "assistant", "content": refs},
                     {"role": "user", "content": correction_message}
-                ])
+                ]
                 print("Incorrect format detected, requesting correction...")
+            
+            print(f"Maximum retries reached, no valid references for section: {section}")
+            return ""
                 
         except Exception as e:
             print(f"Error getting GPT response: {e}")
@@ -156,46 +190,121 @@ class ReferenceSelectionAgent:
     def _save_refs(self, paper_id: str, section_refs: Dict[str, List[str]]):
         """Save selected references to JSON file"""
         output_file = os.path.join(self.output_dir, f'{paper_id}.json')
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(section_refs, f, indent=2, ensure_ascii=False)
+        dump_json(section_refs, output_file)
+        self.store.put(paper_id, 'references', section_refs)
         print(f"Saved references to: {output_file}")
 
-    def process_papers(self) -> None:
+    def _sections_to_process(self, paper_info: PaperInfo) -> List[str]:
+        """Return the outline sections that need references"""
+        return [
+            section for section in paper_info.outline
+            if section not in ['Introduction', 'Conclusion']  # Skip intro and conclusion
+        ]
+
+    def process_one(self, paper_id: str) -> None:
+        """Select and save the references of each section for a single paper"""
+        print(f"\nProcessing paper: {paper_id}")
+        
+        # Read paper information
+        paper_info = self._read_paper_info(paper_id)
+        if not paper_info:
+            print(f"Skipping paper {paper_id} due to missing information")
+            return
+        
+        # Process each section
+        # 主要耗时在API网络请求上，各section并发请求，按大纲顺序收集结果
+        sections = self._sections_to_process(paper_info)
+        all_refs = list(self.executor.map(
+            lambda section: self._get_refs_for_section(paper_info, section),
+            sections
+        ))
+        self._finish_paper(paper_id, sections, all_refs)
+
+    def _finish_paper(self, paper_id: str, sections: List[str], all_refs: List[str]) -> None:
+        """Extract the reference lists of each section and save them"""
+        section_refs = {}
+        for section, refs in zip(sections, all_refs):
+            if refs:
+                # Extract reference numbers
+                content = refs[6:-7].strip()  # Remove <refs> tags
+                ref_list = [line.strip() for line in content.split('\n') if line.strip()]
+                section_refs[section] = ref_list
+                print(f"Selected {len(ref_list)} references for section: {section}")
+        
+        # Save results
+        self._save_refs(paper_id, section_refs)
+        print(f"Completed reference selection for paper: {paper_id}")
+
+    def _process_papers_batch(self, paper_ids: Tuple[str, ...]) -> None:
+        """Select references for all papers through one Batch API job"""
+        papers = {}
+        requests = []
+        for paper_id in paper_ids:
+            paper_info = self._read_paper_info(paper_id)
+            if not paper_info:
+                print(f"Skipping paper {paper_id} due to missing information")
+                continue
+            sections = self._sections_to_process(paper_info)
+            papers[paper_id] = (paper_info, sections)
+            # custom_id用section序号而不是标题，避免标题里出现分隔符
+            for i, section in enumerate(sections):
+                messages = [{"role": "user", "content": self._format_prompt(paper_info, section)}]
+                requests.append((f'{paper_id}::{i}', messages))
+        
+        replies = run_batch(requests, temperature=0.7)
+        # batch结果缺失或格式不对的section改用同步请求，走原来的格式纠正流程；
+        # batch整体过期时可能所有section都要重试，所以用线程池并发请求
+        failed = [
+            (paper_id, i)
+            for paper_id, (paper_info, sections) in papers.items()
+            for i in range(len(sections))
+            if not _verify_refs_format(replies.get(f'{paper_id}::{i}', ''))
+        ]
+        if failed:
+            print(f"Retrying {len(failed)} sections without the Batch API")
+        
+        def retry(key):
+            paper_info, sections = papers[key[0]]
+            return self._get_refs_for_section(paper_info, sections[key[1]])
+        
+        for (paper_id, i), refs in zip(failed, self.executor.map(retry, failed)):
+            replies[f'{paper_id}::{i}'] = refs
+        
+        for paper_id, (paper_info, sections) in papers.items():
+            all_refs = [replies[f'{paper_id}::{i}'] for i in range(len(sections))]
+            self._finish_paper(paper_id, sections, all_refs)
+
+    def process_papers(self, batch: bool = False, skip_existing: bool = True) -> None:
         """Process all papers that have title and outline"""
         print("\nStarting reference selection process...")
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        title_dir = os.path.join(current_dir, 'title')
-        
-        for file_name in os.listdir(title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Read paper information
-                paper_info = self._read_paper_info(paper_id)
-                if not paper_info:
-                    print(f"Skipping paper {paper_id} due to missing information")
-                    continue
-                
-                # Process each section
-                section_refs = {}
-                for section in paper_info['outline']:
-                    if section not in ['Introduction', 'Conclusion']:  # Skip intro and conclusion
-                        refs = self._get_refs_for_section(paper_info, section)
-                        if refs:
-                            # Extract reference numbers
-                            content = refs[6:-7].strip()  # Remove <refs> tags
-                            ref_list = [line.strip() for line in content.split('\n') if line.strip()]
-                            section_refs[section] = ref_list
-                            print(f"Selected {len(ref_list)} references for section: {section}")
-                
-                # Save results
-                self._save_refs(paper_id, section_refs)
-                print(f"Completed reference selection for paper: {paper_id}")
+        paper_ids = list_paper_ids(_TITLE_DIR)
+        if skip_existing:
+            # 已有输出的论文不再重复请求GPT，重跑时只处理新增的论文
+            pending = pending_paper_ids(paper_ids, self.output_dir)
+            print(f"Skipping {len(paper_ids) - len(pending)} papers with existing output")
+            paper_ids = pending
+        if batch:
+            # Batch API费用减半且不受速率限制，但结果最长要24小时才返回
+            self._process_papers_batch(paper_ids)
+            return
+        # 多篇论文也并发处理，每篇论文内部再按section并发
+        with ThreadPoolExecutor(max_workers=self.max_paper_workers) as executor:
+            list(executor.map(self.process_one, paper_ids))
+
+    def close(self) -> None:
+        """Shut down the section thread pool once processing is finished"""
+        self.executor.shutdown()
 
 def main():
+    parser = argparse.ArgumentParser(description="Select references for each section")
+    parser.add_argument('--batch', action='store_true', help="submit all requests through the OpenAI Batch API")
+    parser.add_argument('--force', action='store_true', help="regenerate papers that already have output")
+    args = parser.parse_args()
     agent = ReferenceSelectionAgent()
-    agent.process_papers()
+    try:
+        agent.process_papers(batch=args.batch, skip_existing=not args.force)
+    finally:
+        agent.close()
     print("\nReference selection completed!")
 
 if __name__ == "__main__":
@@ -3,46 +3,89 @@ Subsection Generation Agent - Generates subsection headings for each section
 """
 
 import os
-import json
-import re
-from typing import List, Dict, Tuple
-import yaml
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from config import client, model_name
+from paper_store import PaperStore
+from paper_info import PaperInfo
+from batch_api import run_batch
+from utils import dump_json, load_prompts, list_paper_ids, pending_paper_ids, prefill_prompt, fill_prompt, strip_tag
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+_OUTLINE_DIR = os.path.join(_BASE_DIR, 'outline')
+_REFERENCES_DIR = os.path.join(_BASE_DIR, 'references')
+_SUBSECTIONS_DIR = os.path.join(_BASE_DIR, 'subsections')
+
+# 校验只依赖字符串本身，模型重复返回同样的错误格式时直接用缓存结果
+@lru_cache(maxsize=128)
+def _verify_subsections_format(subsections: str) -> bool:
+    """Verify if the subsections are in correct format"""
+    if not (subsections.startswith('<subsections>') and subsections.endswith('</subsections>')):
+        print("Subsections format verification failed: Missing tags")
+        return False
+        
+    content = subsections[13:-14].strip()  # Remove tags
+    lines = [line.strip() for line in content.split('\n') if line.strip()]
+    
+    if not (3 <= len(lines) <= 5):
+        print(f"Subsections format verification failed: Wrong number of subsections ({len(lines)})")
+        return False
+        
+    if not all(line.startswith('* ') for line in lines):
+        print("Subsections format verification failed: Missing asterisks")
+        return False
+    
+    print("Subsections format verification passed")
+    return True
 
 class SubsectionAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None):
         """Initialize the Subsection Agent"""
         print("Initializing SubsectionAgent...")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
         print(f"Loading prompt from: {prompt_file}")
         self.prompt = self._load_prompt(prompt_file)
         
         # 创建subsections输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'subsections')
+        self.output_dir = _SUBSECTIONS_DIR
         os.makedirs(self.output_dir, exist_ok=True)
         print(f"Output directory: {self.output_dir}")
+        
+        # 前面agent写入的title/outline/references优先从内存store读取，没有时再读磁盘
+        self.store = store if store is not None else PaperStore()
+        
+        # 同一篇论文的各个section并发请求GPT的最大线程数，以及同时处理的论文数
+        self.max_workers = 16
+        self.max_paper_workers = 4
+        # 所有论文共用一个section请求线程池，并发上限不随同时处理的论文数成倍增长
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        
+        # 格式纠正的最大请求次数
+        self.max_retries = 3
 
     def _load_prompt(self, prompt_file: str) -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                if 'subsection_prompt' not in prompt_data:
-                    raise KeyError("'subsection_prompt' not found in YAML file")
-                print("Prompt loaded successfully")
-                return prompt_data['subsection_prompt']
+            prompt_data = load_prompts(prompt_file)
+            if 'subsection_prompt' not in prompt_data:
+                raise KeyError("'subsection_prompt' not found in YAML file")
+            print("Prompt loaded successfully")
+            return prompt_data['subsection_prompt']
         except Exception as e:
             print(f"Error loading prompt file: {e}")
             raise
 
-    def _read_paper_info(self, paper_id: str) -> Dict:
+    def _read_paper_info(self, paper_id: str) -> Optional[PaperInfo]:
         """Read all necessary information for a paper"""
         try:
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            
             # Read subject from test file
-            test_file = os.path.join(current_dir, 'test', f'{paper_id}.txt')
+            test_file = os.path.join(_TEST_DIR, f'{paper_id}.txt')
             with open(test_file, 'r', encoding='utf-8') as f:
                 content = f.read()
                 for line in content.split('\n'):
@@ -52,73 +95,56 @@ class SubsectionAgent:
                             break
             
             # Read title
-            title_file = os.path.join(current_dir, 'title', f'{paper_id}.json')
-            with open(title_file, 'r', encoding='utf-8') as f:
-                title_data = json.load(f)
-                title = re.sub(r'<title>|</title>', '', title_data.get('title', '')).strip()
+            title_file = os.path.join(_TITLE_DIR, f'{paper_id}.json')
+            title_data = self.store.load(paper_id, 'title', title_file)
+            title = strip_tag(title_data.get('title', ''), 'title')
             
             # Read outline
-            outline_file = os.path.join(current_dir, 'outline', f'{paper_id}.json')
-            with open(outline_file, 'r', encoding='utf-8') as f:
-                outline_data = json.load(f)
-                sections = outline_data.get('sections', [])
-                cleaned_sections = []
-                for section in sections:
-                    if not (section.startswith('<outline>') or 
-                           section.startswith('</outline>') or
-                           section == ""):
-                        cleaned_sections.append(section)
+            outline_file = os.path.join(_OUTLINE_DIR, f'{paper_id}.json')
+            outline_data = self.store.load(paper_id, 'outline', outline_file)
+            sections = outline_data.get('sections', [])
+            cleaned_sections = [
+                section for section in sections
+                if section and not section.startswith(('<outline>', '</outline>'))
+            ]
             
             # Read section references
-            refs_file = os.path.join(current_dir, 'references', f'{paper_id}.json')
-            with open(refs_file, 'r', encoding='utf-8') as f:
-                section_refs = json.load(f)
+            refs_file = os.path.join(_REFERENCES_DIR, f'{paper_id}.json')
+            section_refs = self.store.load(paper_id, 'references', refs_file)
             
-            return {
-                'subject': subject,
-                'title': title,
-                'outline': cleaned_sections,
-                'section_refs': section_refs
-            }
+            # 大纲每篇论文只拼接一次
+            outline_str = '\n'.join(cleaned_sections)
+            return PaperInfo(
+                subject=subject,
+                title=title,
+                outline=cleaned_sections,
+                outline_str=outline_str,
+                section_refs=section_refs,
+                # subject/title/outline对同一篇论文的所有section都相同，只填一次
+                prompt_parts=prefill_prompt(
+                    self.prompt,
+                    subject=subject,
+                    title=title,
+                    outline=outline_str
+                )
+            )
         except Exception as e:
             print(f"Error reading paper info: {e}")
-            return {}
+            return None
 
-    def _verify_subsections_format(self, subsections: str) -> bool:
-        """Verify if the subsections are in correct format"""
-        if not (subsections.startswith('<subsections>') and subsections.endswith('</subsections>')):
-            print("Subsections format verification failed: Missing tags")
-            return False
-            
-        content = subsections[13:-14].strip()  # Remove tags
-        lines = [line.strip() for line in content.split('\n') if line.strip()]
-        
-        if not (3 <= len(lines) <= 5):
-            print(f"Subsections format verification failed: Wrong number of subsections ({len(lines)})")
-            return False
-            
-        if not all(line.startswith('* ') for line in lines):
-            print("Subsections format verification failed: Missing asterisks")
-            return False
-        
-        print("Subsections format verification passed")
-        return True
+    def _format_prompt(self, paper_info: PaperInfo, section: str, section_refs: List[str]) -> str:
+        """Fill in the subsection prompt for a section"""
+        return fill_prompt(paper_info.prompt_parts, section=section, section_refs='\n'.join(section_refs))
 
-    def _get_subsections_for_section(self, paper_info: Dict, section: str, section_refs: List[str]) -> str:
+    def _get_subsections_for_section(self, paper_info: PaperInfo, section: str, section_refs: List[str]) -> str:
         """Get subsection suggestions from GPT for a specific section"""
         try:
             print(f"\nGenerating subsections for section: {section}")
-            formatted_prompt = self.prompt.format(
-                subject=paper_info['subject'],
-                title=paper_info['title'],
-                outline='\n'.join(paper_info['outline']),
-                section=section,
-                section_refs='\n'.join(section_refs)
-            )
+            formatted_prompt = self._format_prompt(paper_info, section, section_refs)
             messages = [{"role": "user", "content": formatted_prompt}]
             
-            while True:  # 循环直到获得正确格式的响应
-                print("Sending request to GPT...")
+            for attempt in range(self.max_retries):  # 限制重试次数
+                print(f"Attempt {attempt + 1}/{self.max_retries}")
                 response = client.chat.completions.create(
                     model=model_name,
                     messages=messages,
@@ -127,7 +153,7 @@ class SubsectionAgent:
                 subsections = response.choices[0].message.content.strip()
                 print("Received response")
                 
-                if self._verify_subsections_format(subsections):
+                if _verify_subsections_format(subsections):
                     return subsections
                 
                 correction_message = (
@@ -138,11 +164,16 @@ class SubsectionAgent:
                     "4. Put each subsection on a new line"
                 )
                 
-                messages.extend([
+                # 只保留原prompt和最近一次回答，不累积之前的对话，避免每次重试的上下文越来越长
+                messages = [
+                    {"role": "user", "content": formatted_prompt},
                     {"role": "assistant", "content": subsections},
                     {"role": "user", "content": correction_message}
-                ])
+                ]
                 print("Incorrect format detected, requesting correction...")
+            
+            print(f"Maximum retries reached, no valid subsections for section: {section}")
+            return ""
                 
         except Exception as e:
             print(f"Error getting GPT response: {e}")
@@ -156,54 +187,129 @@ class SubsectionAgent:
             'paper_id': paper_id,
             'sections': section_subsections
         }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        dump_json(result, output_file)
+        self.store.put(paper_id, 'subsections', result)
         print(f"Saved subsections to: {output_file}")
 
-    def process_papers(self) -> None:
+    def _sections_to_process(self, paper_info: PaperInfo) -> List[str]:
+        """Return the outline sections that have references to build subsections from"""
+        return [
+            section for section in paper_info.outline
+            if section not in ['Introduction', 'Conclusion']  # Skip intro and conclusion
+            and paper_info.section_refs.get(section)
+        ]
+
+    def process_one(self, paper_id: str) -> None:
+        """Generate and save the subsections for a single paper"""
+        print(f"\nProcessing paper: {paper_id}")
+        
+        # Read paper information
+        paper_info = self._read_paper_info(paper_id)
+        if not paper_info:
+            print(f"Skipping paper {paper_id} due to missing information")
+            return
+        
+        # Process each section
+        # 主要耗时在API网络请求上，各section并发请求，按大纲顺序收集结果
+        sections = self._sections_to_process(paper_info)
+        all_subsections = list(self.executor.map(
+            lambda section: self._get_subsections_for_section(
+                paper_info, section, paper_info.section_refs[section]
+            ),
+            sections
+        ))
+        self._finish_paper(paper_id, sections, all_subsections)
+
+    def _finish_paper(self, paper_id: str, sections: List[str], all_subsections: List[str]) -> None:
+        """Extract the subsection lists of each section and save them"""
+        section_subsections = {}
+        for section, subsections in zip(sections, all_subsections):
+            if subsections:
+                # Extract subsection list
+                content = subsections[13:-14].strip()  # Remove tags
+                subsection_list = [
+                    line.strip()[2:].strip()  # Remove '* ' prefix
+                    for line in content.split('\n')
+                    if line.strip()
+                ]
+                section_subsections[section] = subsection_list
+                print(f"Generated {len(subsection_list)} subsections for: {section}")
+        
+        # Save results
+        self._save_subsections(paper_id, section_subsections)
+        print(f"Completed subsection generation for paper: {paper_id}")
+
+    def _process_papers_batch(self, paper_ids: Tuple[str, ...]) -> None:
+        """Generate subsections for all papers through one Batch API job"""
+        papers = {}
+        requests = []
+        for paper_id in paper_ids:
+            paper_info = self._read_paper_info(paper_id)
+            if not paper_info:
+                print(f"Skipping paper {paper_id} due to missing information")
+                continue
+            sections = self._sections_to_process(paper_info)
+            papers[paper_id] = (paper_info, sections)
+            # custom_id用section序号而不是标题，避免标题里出现分隔符
+            for i, section in enumerate(sections):
+                prompt = self._format_prompt(paper_info, section, paper_info.section_refs[section])
+                requests.append((f'{paper_id}::{i}', [{"role": "user", "content": prompt}]))
+        
+        replies = run_batch(requests, temperature=0.7)
+        # batch结果缺失或格式不对的section改用同步请求，走原来的格式纠正流程；
+        # batch整体过期时可能所有section都要重试，所以用线程池并发请求
+        failed = [
+            (paper_id, i)
+            for paper_id, (paper_info, sections) in papers.items()
+            for i in range(len(sections))
+            if not _verify_subsections_format(replies.get(f'{paper_id}::{i}', ''))
+        ]
+        if failed:
+            print(f"Retrying {len(failed)} sections without the Batch API")
+        
+        def retry(key):
+            paper_info, sections = papers[key[0]]
+            section = sections[key[1]]
+            return self._get_subsections_for_section(paper_info, section, paper_info.section_refs[section])
+        
+        for (paper_id, i), subsections in zip(failed, self.executor.map(retry, failed)):
+            replies[f'{paper_id}::{i}'] = subsections
+        
+        for paper_id, (paper_info, sections) in papers.items():
+            all_subsections = [replies[f'{paper_id}::{i}'] for i in range(len(sections))]
+            self._finish_paper(paper_id, sections, all_subsections)
+
+    def process_papers(self, batch: bool = False, skip_existing: bool = True) -> None:
         """Process all papers that have title, outline, and references"""
         print("\nStarting subsection generation process...")
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        title_dir = os.path.join(current_dir, 'title')
-        
-        for file_name in os.listdir(title_dir):
-            if file_name.endswith('.json'):
-                paper_id = os.path.splitext(file_name)[0]
-                print(f"\nProcessing paper: {paper_id}")
-                
-                # Read paper information
-                paper_info = self._read_paper_info(paper_id)
-                if not paper_info:
-                    print(f"Skipping paper {paper_id} due to missing information")
-                    continue
-                
-                # Process each section
-                section_subsections = {}
-                for section in paper_info['outline']:
-                    if section not in ['Introduction', 'Conclusion']:  # Skip intro and conclusion
-                        section_refs = paper_info['section_refs'].get(section, [])
-                        if section_refs:
-                            subsections = self._get_subsections_for_section(
-                                paper_info, section, section_refs
-                            )
-                            if subsections:
-                                # Extract subsection list
-                                content = subsections[13:-14].strip()  # Remove tags
-                                subsection_list = [
-                                    line.strip()[2:].strip()  # Remove '* ' prefix
-                                    for line in content.split('\n')
-                                    if line.strip()
-                                ]
-                                section_subsections[section] = subsection_list
-                                print(f"Generated {len(subsection_list)} subsections for: {section}")
-                
-                # Save results
-                self._save_subsections(paper_id, section_subsections)
-                print(f"Completed subsection generation for paper: {paper_id}")
+        paper_ids = list_paper_ids(_TITLE_DIR)
+        if skip_existing:
+            # 已有输出的论文不再重复请求GPT，重跑时只处理新增的论文
+            pending = pending_paper_ids(paper_ids, self.output_dir)
+            print(f"Skipping {len(paper_ids) - len(pending)} papers with existing output")
+            paper_ids = pending
+        if batch:
+            # Batch API费用减半且不受速率限制，但结果最长要24小时才返回
+            self._process_papers_batch(paper_ids)
+            return
+        # 多篇论文也并发处理，每篇论文内部再按section并发
+        with ThreadPoolExecutor(max_workers=self.max_paper_workers) as executor:
+            list(executor.map(self.process_one, paper_ids))
+
+    def close(self) -> None:
+        """Shut down the section thread pool once processing is finished"""
+        self.executor.shutdown()
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate subsection headings for each section")
+    parser.add_argument('--batch', action='store_true', help="submit all requests through the OpenAI Batch API")
+    parser.add_argument('--force', action='store_true', help="regenerate papers that already have output")
+    args = parser.parse_args()
     agent = SubsectionAgent()
-    agent.process_papers()
+    try:
+        agent.process_papers(batch=args.batch, skip_existing=not args.force)
+    finally:
+        agent.close()
     print("\nSubsection generation completed!")
 
 if __name__ == "__main__":
@@ -3,65 +3,132 @@ Title Generation Agent - Generates paper title based on references and subject
 """
 
 import os
-import json
+import argparse
+import mmap
 import re
-from typing import List, Dict, Tuple
-import yaml
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Dict, Optional, Tuple
+import httpx
+from openai import DefaultHttpxClient
 from config import client, model_name
+from llm_cache import LLMCache
+from paper_store import PaperStore
+from traintestsplit import iter_papers
+from utils import dump_json, dumps_json, loads_json, load_prompts, list_paper_ids, prefill_prompt, fill_prompt
+
+# 目录路径只在导入时计算一次
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_BASE_DIR = os.path.dirname(_SRC_DIR)
+_TEST_DIR = os.path.join(_BASE_DIR, 'test')
+_TITLE_DIR = os.path.join(_BASE_DIR, 'title')
+# process_folder(jsonl=True)时所有标题追加到这一个文件
+_TITLES_JSONL = os.path.join(_TITLE_DIR, 'titles.jsonl')
+
+# 预编译正则，避免每次校验都在re的内部缓存里查找
+_TITLE_RE = re.compile(r'^<title>.*</title>$')
+# 测试文件按References:行分成两部分：前面是Subjects块，后面每条参考文献的Title:行
+# 直接在mmap的字节上匹配，只解码匹配到的部分
+_SUBJECTS_LINE_RE = re.compile(rb'^[ \t]*Subjects:[ \t\r]*$', re.M)
+_REFERENCES_LINE_RE = re.compile(rb'^[ \t]*References:[ \t\r]*$', re.M)
+_NONEMPTY_LINE_RE = re.compile(rb'^[ \t]*(\S.*?)[ \t\r]*$', re.M)
+_REF_TITLE_RE = re.compile(rb'^[ \t]*Title:[ \t]*(.*?)[ \t\r]*$', re.M)
+# 合并请求的响应中每篇论文的标题块
+_TITLE_BLOCK_RE = re.compile(r'<title id="(\d+)">(.*?)</title>', re.S)
 
 class TitleAgent:
-    def __init__(self):
+    def __init__(self, store: Optional[PaperStore] = None, use_cache: bool = True):
         """Initialize the Title Agent"""
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompt_file = os.path.join(current_dir, 'prompts.yaml')
+        prompt_file = os.path.join(_SRC_DIR, 'prompts.yaml')
         self.prompt = self._load_prompt(prompt_file)
+        # 模板只解析一次，每篇论文只需拼接subject和references
+        self.prompt_parts = prefill_prompt(self.prompt)
+        self.batch_prompt = self._load_prompt(prompt_file, 'title_batch_prompt')
         
         # 创建title输出目录
-        self.output_dir = os.path.join(os.path.dirname(current_dir), 'title')
+        self.output_dir = _TITLE_DIR
         os.makedirs(self.output_dir, exist_ok=True)
         
-    def _load_prompt(self, prompt_file: str) -> str:
+        # 与后续agent共享的内存store，保存的结果同时放进去
+        self.store = store if store is not None else PaperStore()
+        
+        # 每个文件的耗时几乎都在GPT请求上，多个文件并发请求的最大线程数
+        self.max_workers = 16
+        
+        # 多篇论文合并成一次请求，每次最多合并的数量
+        self.batch_size = 4
+        
+        # 每篇论文最多放进prompt的参考文献标题数（取前K条），控制prompt的token数，
+        # 参考文献很多时请求的延迟和费用不会随之增长
+        self.max_refs = 25
+        
+        # 回复中缺少标题时的最大请求次数
+        self.max_retries = 3
+        
+        # 所有线程共用一个连接池并保持长连接，后续请求不再重新做TCP/TLS握手
+        # 429/5xx/连接错误交给openai SDK自带的指数退避（带抖动）重试，单次请求最多等30秒
+        self.client = client.with_options(
+            max_retries=5,
+            timeout=30,
+            http_client=DefaultHttpxClient(
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30)
+            )
+        )
+        
+        # 打开时标题写入titles.jsonl而不是每篇论文一个文件，多个线程共用一个文件句柄
+        self._sink = None
+        self._sink_lock = threading.Lock()
+        
+        # 通过格式校验的标题按单篇论文的prompt缓存，重跑或输入相同时不再请求GPT
+        self.cache = LLMCache(f'title:{model_name}') if use_cache else None
+        
+    def _load_prompt(self, prompt_file: str, key: str = 'title_prompt') -> str:
         """Load prompt template from YAML file"""
         try:
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = yaml.safe_load(f)
-                return prompt_data['title_prompt']
+            prompt_data = load_prompts(prompt_file)
+            return prompt_data[key]
         except Exception as e:
             print(f"Error loading prompt file: {e}")
             return ""
 
-    def _extract_content(self, file_content: str) -> Tuple[str, str]:
+    def _extract_content(self, file_content: bytes) -> Tuple[str, str]:
         """
         Extract subject and references from the file content
         Returns:
             Tuple[str, str]: (subject, references)
         """
-        lines = file_content.split('\n')
+        # 用正则在C层扫描，不再把整个文件拆成行列表逐行判断
+        refs_line = _REFERENCES_LINE_RE.search(file_content)
+        header_end = refs_line.start() if refs_line else len(file_content)
+        
+        # subject取Subjects:之后的最后一个非空行
         subject = ""
+        subjects_line = _SUBJECTS_LINE_RE.search(file_content, 0, header_end)
+        if subjects_line:
+            lines = _NONEMPTY_LINE_RE.findall(file_content, subjects_line.end(), header_end)
+            if lines:
+                subject = lines[-1].decode('utf-8')
+        
         references = []
-        current_section = ""
-
-        for line in lines:
-            line = line.strip()
-            if line == "Subjects:":
-                current_section = "subjects"
-            elif line == "References:":
-                current_section = "references"
-            elif line and current_section == "subjects" and line != "Subjects:":
-                subject = line
-            elif line and current_section == "references":
-                if line.startswith('Title:'):
-                    references.append(line[6:].strip())
-
-        return subject, '\n'.join(references)
+        if refs_line:
+            # 取够max_refs条就停止扫描，不再匹配文件剩余部分
+            for match in _REF_TITLE_RE.finditer(file_content, refs_line.end()):
+                if len(references) >= self.max_refs:
+                    break
+                references.append(match.group(1))
+        return subject, b'\n'.join(references).decode('utf-8')
 
 
     def _read_reference_file(self, file_path: str) -> Dict:
         """Read and parse a single reference file"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            subject, references = self._extract_content(content)
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    subject, references = self._extract_content(b'')  # 空文件不能mmap
+                else:
+                    # 映射文件而不是读成str，省去整个文件的解码和拷贝
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        subject, references = self._extract_content(mm)
             return {
                 'id': os.path.splitext(os.path.basename(file_path))[0],
                 'subject': subject,
@@ -73,86 +140,224 @@ class TitleAgent:
 
     def _verify_title_format(self, title: str) -> bool:
         """Verify if the title is in correct format: <title>text</title>"""
-        pattern = r'^<title>.*</title>$'
-        return bool(re.match(pattern, title.strip()))
+        return bool(_TITLE_RE.match(title.strip()))
+
+    def _parse_title(self, content: Optional[str]) -> str:
+        """Extract the title from a JSON reply and wrap it in <title> tags, or return an empty string"""
+        try:
+            data = loads_json(content or '')
+        except ValueError:
+            return ""
+        title = data.get('title') if isinstance(data, dict) else None
+        if not isinstance(title, str) or not title.strip():
+            return ""
+        # 后续agent和XML都按<title>标签读取标题，这里补上标签
+        return f"<title>{title.strip()}</title>"
 
     def _get_title_from_gpt(self, subject: str, references: str) -> str:
         """Get title suggestion from GPT"""
         try:
-            formatted_prompt = self.prompt.format(
-                subject=subject,
-                references=references
-            )
+            formatted_prompt = fill_prompt(self.prompt_parts, subject=subject, references=references)
+            if self.cache is not None:
+                cached = self.cache.get(formatted_prompt)
+                if cached is not None:
+                    return cached
             messages = [{"role": "user", "content": formatted_prompt}]
             
-            while True:  # 循环直到获得正确格式的响应
-                response = client.chat.completions.create(
+            # JSON mode保证返回合法的JSON，不再需要带着之前的对话请求格式纠正；只在缺少title字段时重新请求
+            for attempt in range(self.max_retries):
+                response = self.client.chat.completions.create(
                     model=model_name,
                     messages=messages,
-                    temperature=0.7
+                    temperature=0.7,
+                    response_format={"type": "json_object"}
                 )
-                title = response.choices[0].message.content.strip()
-                
-                if self._verify_title_format(title):
+                title = self._parse_title(response.choices[0].message.content)
+                if title:
+                    if self.cache is not None:
+                        self.cache.put(formatted_prompt, title)
                     return title
-                
-                # 如果格式不正确，添加纠正提示并继续对话
-                correction_message = (
-                    "The response format is incorrect. Please wrap your title in <title> tags. "
-                    "For example: <title>Your Title Here</title>"
-                )
-                
-                messages.extend([
-                    {"role": "assistant", "content": title},
-                    {"role": "user", "content": correction_message}
-                ])
-                print(f"Incorrect format detected, requesting correction...")
+                print(f"Missing title in response, retrying ({attempt + 1}/{self.max_retries})...")
+            
+            print("Maximum retries reached, no valid title")
+            return ""
                 
         except Exception as e:
             print(f"Error getting GPT response: {e}")
             return ""
 
-    def _save_title(self, paper_id: str, title: str):
-        """Save title to individual JSON file"""
+    def _get_titles_batch(self, rows: List[Tuple[str, str]]) -> List[str]:
+        """Get title suggestions for several (subject, references) rows in one request"""
+        if len(rows) == 1:
+            return [self._get_title_from_gpt(*rows[0])]
+        
+        # 缓存按单篇论文的prompt查找，命中的论文不再放进合并请求
+        prompts = [fill_prompt(self.prompt_parts, subject=subject, references=references) for subject, references in rows]
+        titles = [
+            (self.cache.get(prompt) if self.cache is not None else None) or ''
+            for prompt in prompts
+        ]
+        pending = [i for i, title in enumerate(titles) if not title]
+        if len(pending) > 1:
+            try:
+                papers = '\n\n'.join(
+                    f"Paper {n}:\nSubject: {rows[i][0]}\nReferences: {rows[i][1]}"
+                    for n, i in enumerate(pending, 1)
+                )
+                response = self.client.chat.completions.create(
+                    model=model_name,
+                    messages=[{"role": "user", "content": self.batch_prompt.format(papers=papers)}],
+                    temperature=0.7
+                )
+                # 按id拆出每篇论文的标题，逐个做格式校验
+                for block_id, text in _TITLE_BLOCK_RE.findall(response.choices[0].message.content):
+                    index = int(block_id) - 1
+                    title = f"<title>{text.strip()}</title>"
+                    if 0 <= index < len(pending) and self._verify_title_format(title):
+                        titles[pending[index]] = title
+                        if self.cache is not None:
+                            self.cache.put(prompts[pending[index]], title)
+            except Exception as e:
+                print(f"Error getting GPT response: {e}")
+        
+        # 缺失或校验失败的论文单独重新请求
+        return [
+            title or self._get_title_from_gpt(*row)
+            for title, row in zip(titles, rows)
+        ]
+
+    def _save_title(self, paper_id: str, title: str) -> str:
+        """Save title to individual JSON file and return the title that was written"""
         output_file = os.path.join(self.output_dir, f'{paper_id}.json')
+        if not title:
+            # 重试用尽仍没有标题时用固定的占位标题，后续步骤照常进行
+            print(f"Warning: No title generated for {paper_id}, using a placeholder")
+            title = f"<title>Untitled_{paper_id}</title>"
         result = {
             'paper_id': paper_id,
             'title': title
         }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        if self._sink is not None:
+            line = dumps_json(result) + b'\n'
+            with self._sink_lock:
+                self._sink.write(line)
+        else:
+            dump_json(result, output_file)
+        self.store.put(paper_id, 'title', result)
+        return title
 
-    def process_folder(self) -> List[Dict[str, str]]:
-        """Process all txt files in the test folder"""
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        test_folder = os.path.join(current_dir, 'test')
+    def process_one(self, paper_id: str) -> Dict[str, str]:
+        """Generate and save the title for a single paper"""
+        file_path = os.path.join(_TEST_DIR, f'{paper_id}.txt')
+        ref_data = self._read_reference_file(file_path)
         
-        results = []
-        for file_name in os.listdir(test_folder):
-            if file_name.endswith('.txt'):
-                file_path = os.path.join(test_folder, file_name)
-                ref_data = self._read_reference_file(file_path)
-                
-                if ref_data and ref_data.get('subject') and ref_data.get('references'):
-                    title = self._get_title_from_gpt(ref_data['subject'], ref_data['references'])
-                    result = {
-                        'paper_id': ref_data['id'],
-                        'title': title
-                    }
-                    results.append(result)
-                    
-                    # 保存单独的JSON文件
-                    self._save_title(ref_data['id'], title)
-                    
-                    print(f"Generated title for {ref_data['id']}: {title}")
-                else:
-                    print(f"Warning: Missing subject or references for {file_path}")
+        if ref_data and ref_data.get('subject') and ref_data.get('references'):
+            title = self._get_title_from_gpt(ref_data['subject'], ref_data['references'])
+            
+            # 保存单独的JSON文件
+            title = self._save_title(ref_data['id'], title)
+            
+            print(f"Generated title for {ref_data['id']}: {title}")
+            return {
+                'paper_id': ref_data['id'],
+                'title': title
+            }
+        print(f"Warning: Missing subject or references for {file_path}")
+        return {}
 
+    def _process_chunk(self, chunk: List[Dict]) -> List[Dict[str, str]]:
+        """Generate and save the titles for a group of papers with one request"""
+        titles = self._get_titles_batch([(ref_data['subject'], ref_data['references']) for ref_data in chunk])
+        results = []
+        for ref_data, title in zip(chunk, titles):
+            title = self._save_title(ref_data['id'], title)
+            print(f"Generated title for {ref_data['id']}: {title}")
+            results.append({
+                'paper_id': ref_data['id'],
+                'title': title
+            })
         return results
 
+    def process_folder(self, jsonl: bool = False) -> List[Dict[str, str]]:
+        """Process all txt files in the test folder, optionally collecting the titles in titles.jsonl"""
+        return self._with_sink(jsonl, self._process_folder)
+
+    def process_iter(self, papers: Iterable[Tuple[str, str, str]], jsonl: bool = False) -> List[Dict[str, str]]:
+        """Process (paper_id, subject, references) tuples, e.g. from traintestsplit.iter_papers"""
+        return self._with_sink(jsonl, lambda: self._process_rows(self._collect_rows(papers)))
+
+    def _with_sink(self, jsonl: bool, run):
+        """Run run(), collecting the titles in titles.jsonl if jsonl is True"""
+        if jsonl:
+            self._sink = open(_TITLES_JSONL, 'ab', buffering=1 << 16)
+            try:
+                return run()
+            finally:
+                # 所有标题写完后统一刷新一次
+                self._sink.close()
+                self._sink = None
+        return run()
+
+    def _collect_rows(self, papers: Iterable[Tuple[str, str, str]]) -> List[Dict]:
+        """Turn (paper_id, subject, references) tuples into the rows read from test files"""
+        rows = []
+        for paper_id, subject, references in papers:
+            # 与_extract_content一样只保留前max_refs条参考文献标题
+            references = '\n'.join(references.split('\n', self.max_refs)[:self.max_refs])
+            if subject and references:
+                rows.append({'id': paper_id, 'subject': subject, 'references': references})
+            else:
+                print(f"Warning: Missing subject or references for {paper_id}")
+        return rows
+
+    def _process_folder(self) -> List[Dict[str, str]]:
+        """Generate and save the titles for all txt files in the test folder"""
+        rows = []
+        for paper_id in list_paper_ids(_TEST_DIR, '.txt'):
+            file_path = os.path.join(_TEST_DIR, f'{paper_id}.txt')
+            ref_data = self._read_reference_file(file_path)
+            if ref_data and ref_data.get('subject') and ref_data.get('references'):
+                rows.append(ref_data)
+            else:
+                print(f"Warning: Missing subject or references for {file_path}")
+        return self._process_rows(rows)
+
+    def _process_rows(self, rows: List[Dict]) -> List[Dict[str, str]]:
+        """Generate and save the titles for rows of paper id, subject and references"""
+        # 每batch_size篇论文合并成一次请求，各组并发请求，按文件顺序收集结果
+        chunks = [rows[i:i + self.batch_size] for i in range(0, len(rows), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._process_chunk, chunks))
+
+        return [result for chunk_results in results for result in chunk_results]
+
+def split_titles_jsonl(jsonl_file: str = _TITLES_JSONL, output_dir: str = _TITLE_DIR) -> int:
+    """Write each line of a titles.jsonl file to its own <paper_id>.json file"""
+    # 后续agent读取的是每篇论文单独的JSON文件；同一篇论文出现多次时以最后一行为准
+    results = {}
+    with open(jsonl_file, 'rb') as f:
+        for line in f:
+            if line.strip():
+                result = loads_json(line)
+                results[result['paper_id']] = result
+    for paper_id, result in results.items():
+        dump_json(result, os.path.join(output_dir, f'{paper_id}.json'))
+    return len(results)
+
 def main():
+    parser = argparse.ArgumentParser(description="Generate a title for each test file")
+    parser.add_argument('--jsonl', action='store_true', help="append all titles to title/titles.jsonl instead of one file per paper")
+    parser.add_argument('--split', action='store_true', help="only split title/titles.jsonl into per-paper JSON files")
+    parser.add_argument('--train', metavar='DIR', help="read the papers straight from the train JSON files in DIR instead of the test txt files")
+    args = parser.parse_args()
+    if args.split:
+        print(f"Wrote {split_titles_jsonl()} title files")
+        return
     agent = TitleAgent()
-    agent.process_folder()
+    if args.train:
+        agent.process_iter(iter_papers(args.train), jsonl=args.jsonl)
+    else:
+        agent.process_folder(jsonl=args.jsonl)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
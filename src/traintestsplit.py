@@ -2,19 +2,24 @@
 Extract references and subject from JSON files and save as TXT files.
 """
 
-import json
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Iterator, List, Tuple
+from utils import load_json, write_bytes
+
+# 文件名中完整的数字部分 (2002.00564)
+_PAPER_ID_RE = re.compile(r'(\d+\.\d+)')
 
 def extract_references_and_subject(json_file):
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    # orjson可用时用它解析，比标准库json快
+    data = load_json(json_file)
 
     # 提取subject
     subjects = data.get('subject', [])
     
     # 提取references
-    references = []
     reference_list = data.get('reference', [])
     reference_content_list = data.get('reference_content', [])
 
@@ -23,52 +28,79 @@ def extract_references_and_subject(json_file):
         for content in reference_content_list
     }
 
-    for i, ref in enumerate(reference_list):
-        reference_num = f"[{i+1}]"
-        reference_title = ref if isinstance(ref, str) else ref.get('reference_title', "")
-        reference_abstract = reference_content_dict.get(reference_num, "")
-
-        references.append({
-            "num": reference_num,
-            "title": reference_title,
-            "abstract": reference_abstract
-        })
+    # 每条参考文献是(num, title, abstract)元组，生成器直接交给写文件的函数，不再为每条构造dict
+    references = (
+        (
+            f"[{i}]",
+            ref if isinstance(ref, str) else ref.get('reference_title', ""),
+            reference_content_dict.get(f"[{i}]", "")
+        )
+        for i, ref in enumerate(reference_list, 1)
+    )
 
     return subjects, references
 
 def save_references_and_subject_as_txt(subjects, references, output_file):
-    with open(output_file, 'w', encoding='utf-8') as f:
-        # 首先写入subjects
-        f.write("Subjects:\n")
-        for subject in subjects:
-            f.write(f"{subject}\n")
-        f.write("\n")  # 空行分隔
+    # 先在内存里拼好整个文件，编码一次后直接用os.write写入
+    # 首先写入subjects，空行分隔后写入references
+    parts = ["Subjects:\n", *(f"{subject}\n" for subject in subjects), "\nReferences:\n"]
+    parts.extend(
+        f'Number: {num}\nTitle: {title}\nAbstract: {abstract}\n\n'
+        for num, title, abstract in references
+    )
+    write_bytes(output_file, ''.join(parts).encode('utf-8'))
+
+def _convert(json_file, paper_id, output_folder):
+    subjects, references = extract_references_and_subject(json_file)
+    output_file = os.path.join(output_folder, f'{paper_id}.txt')
+    save_references_and_subject_as_txt(subjects, references, output_file)
+
+def _extract_title_input(json_file):
+    try:
+        subjects, references = extract_references_and_subject(json_file)
+        # 与TitleAgent从TXT文件中读出的内容一致：最后一个非空subject，以及每行一个参考文献标题
+        subject = next((str(s).strip() for s in reversed(subjects) if str(s).strip()), "")
+        return subject, '\n'.join(str(title or '').strip() for _, title, _ in references)
+    except Exception as e:
+        # 与TXT流程一样按文件隔离错误，单个坏文件不会中断整个迭代
+        print(f"Error reading file {json_file}: {e}")
+        return None
 
-        # 然后写入references
-        f.write("References:\n")
-        for ref in references:
-            f.write(f'Number: {ref["num"]}\n')
-            f.write(f'Title: {ref["title"]}\n')
-            f.write(f'Abstract: {ref["abstract"]}\n')
-            f.write('\n')
+def _list_json_files(train_folder) -> Tuple[List[str], List[str]]:
+    # scandir的DirEntry自带路径和文件类型，不需要再拼接路径或逐个stat
+    with os.scandir(train_folder) as entries:
+        entries = [entry for entry in entries if entry.name.endswith('.json') and entry.is_file()]
+
+    # 在主进程里一次性用预编译的正则从文件名提取论文ID (2002.00564)，
+    # 提取不到ID的文件直接跳过，不再先解析完JSON才发现无法保存
+    json_files, paper_ids = [], []
+    for entry in entries:
+        match = _PAPER_ID_RE.search(entry.name)
+        if match:
+            json_files.append(entry.path)
+            paper_ids.append(match.group(1))
+        else:
+            print(f"Warning: Could not extract paper ID from {entry.name}")
+    return json_files, paper_ids
+
+def iter_papers(train_folder) -> Iterator[Tuple[str, str, str]]:
+    """Yield (paper_id, subject, references) for each JSON file without writing TXT files"""
+    json_files, paper_ids = _list_json_files(train_folder)
+    # 解析仍在多个进程中并行，结果按文件顺序逐个产出
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for paper_id, extracted in zip(paper_ids, executor.map(_extract_title_input, json_files, chunksize=32)):
+            if extracted is not None:
+                yield (paper_id, *extracted)
 
 def process_all_json_files_and_save_txt(train_folder, output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
-    for file_name in os.listdir(train_folder):
-        if file_name.endswith('.json'):
-            json_file = os.path.join(train_folder, file_name)
-            subjects, references = extract_references_and_subject(json_file)
-
-            # 使用正则表达式提取完整的数字部分 (2002.00564)
-            match = re.search(r'(\d+\.\d+)', file_name)
-            if match:
-                paper_id = match.group(1)
-                output_file = os.path.join(output_folder, f'{paper_id}.txt')
-                save_references_and_subject_as_txt(subjects, references, output_file)
-            else:
-                print(f"Warning: Could not extract paper ID from {file_name}")
+    json_files, paper_ids = _list_json_files(train_folder)
+    # 每个文件互相独立，分给多个进程并行转换
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_convert, json_files, paper_ids, repeat(output_folder), chunksize=32))
 
-# 运行处理
-process_all_json_files_and_save_txt('train', 'test')
\ No newline at end of file
+if __name__ == "__main__":
+    # 运行处理
+    process_all_json_files_and_save_txt('train', 'test')
\ No newline at end of file
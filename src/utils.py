@@ -0,0 +1,120 @@
+"""
+Shared helpers for the survey generation agents
+"""
+
+import os
+import json
+from functools import lru_cache
+from string import Formatter
+from typing import Iterable, List, Optional, Tuple
+import yaml
+
+try:
+    import orjson
+except ImportError:  # orjson是可选依赖，没有安装时回退到标准库json
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as _YamlLoader  # libyaml C实现
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+def loads_json(data):
+    """Parse JSON bytes or str, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def load_json(path: str):
+    """Load a JSON file, using orjson when it is available"""
+    with open(path, 'rb') as f:
+        return loads_json(f.read())
+
+def dumps_json(obj, pretty: bool = False) -> bytes:
+    """Serialize obj to UTF-8 JSON bytes, compact unless pretty is True"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def write_bytes(path: str, data: bytes):
+    """Write data to path with raw os.write calls, replacing any existing file"""
+    # 先写临时文件再rename，中途中断时path要么是旧的完整文件要么不存在
+    tmp_path = path + '.tmp'
+    # 不经过Python的文件对象和缓冲层，通常一次write系统调用就写完
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+def dump_json(obj, path: str, pretty: bool = True):
+    """Write obj to path as UTF-8 JSON, indented unless pretty is False"""
+    write_bytes(path, dumps_json(obj, pretty))
+
+@lru_cache(maxsize=4)
+def load_prompts(prompt_file: str) -> dict:
+    """Parse a prompts YAML file once per process and share it across agents"""
+    # YAML解析结果缓存为同名.json，YAML没有更新时直接读JSON，比解析YAML快得多
+    json_file = os.path.splitext(prompt_file)[0] + '.json'
+    try:
+        if os.path.getmtime(json_file) >= os.path.getmtime(prompt_file):
+            return load_json(json_file)
+    except (OSError, ValueError):
+        pass
+    with open(prompt_file, 'rb') as f:
+        prompt_data = yaml.load(f, Loader=_YamlLoader)
+    try:
+        dump_json(prompt_data, json_file)
+    except OSError:
+        pass  # 缓存写不进去不影响使用
+    return prompt_data
+
+def strip_tag(text: str, tag: str) -> str:
+    """Remove the <tag> and </tag> markers from text and strip the surrounding whitespace"""
+    # 标签是固定字符串，直接replace比正则快
+    return text.replace(f'<{tag}>', '').replace(f'</{tag}>', '').strip()
+
+def prefill_prompt(template: str, **fixed) -> List[Tuple[str, Optional[str]]]:
+    """Fill the fixed fields of a prompt template once, leaving the other fields open"""
+    # 结果是(文本, 待填字段名)的列表，同一篇论文的各section之间只需拼接，不再重新解析整个模板
+    parts = []
+    text = ''
+    for literal, field, spec, _ in Formatter().parse(template):
+        text += literal
+        if field is None:
+            continue
+        if field in fixed:
+            text += format(fixed[field], spec)
+        else:
+            parts.append((text, field))
+            text = ''
+    parts.append((text, None))
+    return parts
+
+def fill_prompt(parts: List[Tuple[str, Optional[str]]], **fields) -> str:
+    """Fill the open fields of a template returned by prefill_prompt"""
+    return ''.join(text + (fields[field] if field else '') for text, field in parts)
+
+def list_paper_ids(directory: str, suffix: str = '.json') -> Tuple[str, ...]:
+    """Return the paper ids (file names without suffix) of the files in directory"""
+    # scandir的DirEntry自带文件类型信息，不需要再逐个stat
+    with os.scandir(directory) as entries:
+        return tuple(
+            entry.name[:-len(suffix)]
+            for entry in entries
+            if entry.name.endswith(suffix) and entry.is_file()
+        )
+
+def pending_paper_ids(paper_ids: Iterable[str], output_dir: str, suffix: str = '.json') -> Tuple[str, ...]:
+    """Return the paper ids that have no output file in output_dir yet"""
+    # 一次列出输出目录，而不是对每篇论文单独stat
+    done = set(list_paper_ids(output_dir, suffix))
+    return tuple(paper_id for paper_id in paper_ids if paper_id not in done)